@@ -45,8 +45,7 @@ class ChatServer(Hyphen0Server):
             timestamp=int(time.time() * 1000)
         )
         
-        for sock in self.connected_users.values():
-            sock.write_packet(chat_packet)
+        self.broadcast(chat_packet, filter=lambda sock: sock in self.user_sockets)
             
     async def _handle_disconnect(self, client, packet):
         """Handle client disconnection"""
@@ -71,8 +70,7 @@ class ChatServer(Hyphen0Server):
         
         # Notify all clients about user leaving
         leave_packet = UserLeaveClientbound(username=username.encode('utf-8'))
-        for sock in self.connected_users.values():
-            sock.write_packet(leave_packet)
+        self.broadcast(leave_packet, filter=lambda sock: sock in self.user_sockets)
             
     async def work(self, client):
         """Main work loop for connected client"""
@@ -91,9 +89,8 @@ class ChatServer(Hyphen0Server):
         
         # Notify all clients about new user
         join_packet = UserJoinClientbound(username=username.encode('utf-8'))
-        for sock in self.connected_users.values():
-            if sock == client: continue # no need to notify client that just connected anyways
-            sock.write_packet(join_packet)
+        # no need to notify client that just connected anyways
+        self.broadcast(join_packet, filter=lambda sock: sock in self.user_sockets and sock != client)
         
         # Continue with normal packet handling
         await super().work(client)
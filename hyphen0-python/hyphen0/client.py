@@ -1,47 +1,106 @@
+import time
 import asyncio
 import functools
 import random
-import traceback
 import inspect
+import logging
+from concurrent.futures import Executor
 from .socket.protosocket import ProtoSocket
 from .socket.cryptsocket import CryptSocket
 
-from .packets.packet import Kick, Disconnect
-from .exceptions import WereKicked
+from .packets.packet import Packet, Kick, Disconnect
+from .exceptions import WereKicked, SocketClosed
 
 from .packets.handshake import HandshakeInitiate, HandshakeConfirm, HandshakeCancel, HandshakeOK, \
                                HandshakeCryptModesList, HandshakeCryptModeSelect, HandshakeCryptOK, \
                                HandshakeCryptKEXClient, HandshakeCryptKEXServer, \
-                               HandshakeCryptTestPing, HandshakeCryptTestPong
+                               HandshakeCryptTestPing, HandshakeCryptTestPong, \
+                               HandshakeFastInitiate, HandshakeFastAccept, \
+                               HandshakeResume, HandshakeResumeAccept, HandshakeResumeReject, HandshakeTicket, \
+                               PROTOCOL_VERSION
 
 from .encryption.aes import AESCrypter
+from .encryption.aes256 import AES256Crypter
+from .encryption.aesgcm import AESGCMCrypter
+from .encryption.chacha20 import ChaCha20Poly1305Crypter
+from .encryption.ranking import rank_modes
+from .encryption.tickets import SessionTicket, resumption_secret, resumed_session_key
 
 from .stegano._layer import SteganoLayer
+from .metrics import prometheus_text
 
-from Crypto.PublicKey import ECC
-from Crypto.Protocol import DH
-from Crypto.Protocol import KDF
-from Crypto.Hash import SHA256
+from Crypto.Random import get_random_bytes
+
+log = logging.getLogger(__name__)
+# see hyphen0.server
+hook_log = logging.getLogger("hyphen0.hooks")
+packet_log = logging.getLogger("hyphen0.packets")
 
 class Hyphen0Client:
     _trace_hooks: bool = True
     _capture_errors: bool = True
 
-    ENCRYPTION_MODES = {'aes': AESCrypter}
+    # sent to the server in this order, reordered by measured throughput on mainloop() start if RANK_ENCRYPTION_MODES is set.
+    # the server picks by its own preference
+    ENCRYPTION_MODES = {'chacha20-poly1305': ChaCha20Poly1305Crypter, 'aes-gcm': AESGCMCrypter, 'aes': AESCrypter, 'aes256': AES256Crypter}
+    RANK_ENCRYPTION_MODES = True
+    # handshake in one round trip instead of five. servers speaking the same protocol version support both
+    FAST_HANDSHAKE = True
+    # one in how many received packets makes it to the packet trace, 0 turns it off, see Hyphen0Server
+    PACKET_TRACE_SAMPLE = 100
 
     def __init__(self, host: str, port: int, steganolayer: SteganoLayer|None = None):
         self._host, self._port = host, port
         self._socket = ProtoSocket(True, 10, 5, steganolayer)
         self._keypair = None
+        self._public_key = None
         self._session_nonce = None
         self._closed = False
         self._stage = ""
         self._hooks = {}
+        self._executor = None
+        self._update_task = None
+        self._resumption_secret = None
+        # last ticket the server issued, hand it to set_ticket() of a later client to resume this session
+        self.ticket = None
+        self._packets_seen = 0
 
     def set_keypair(self, keypair):
+        from Crypto.PublicKey import ECC # the key maths is only loaded once it's needed, importing hyphen0 stays cheap
         if not isinstance(keypair, ECC.EccKey):
             raise ValueError("keypair should be ECCKey")
         self._keypair = keypair
+        self._public_key = keypair.public_key().export_key(format='DER', compress=True)
+
+    def set_ticket(self, ticket: SessionTicket|None):
+        """Ticket to resume an earlier session with, skipping the key exchange. Only used if it's for this host and port and not expired"""
+        self.ticket = ticket
+
+    def set_executor(self, executor: Executor|None, threshold: int = 65536):
+        """Runs key agreement, and crypto and stegano work on payloads of at least `threshold` bytes, on `executor`
+        instead of the event loop thread. Without one, key agreement still runs on the loop's default executor.
+        See ProtoSocket.set_executor"""
+        self._executor = executor
+        self._socket.set_executor(executor, threshold)
+    def enable_metrics(self, enabled: bool = True):
+        """Starts (or stops) counting traffic, handshakes and crypto time of the connection, see metrics()"""
+        self._socket.enable_metrics(enabled)
+    def metrics(self) -> dict|None:
+        """Snapshot of the connection's counters and histograms, see ProtoSocket.metrics(). None if metrics aren't enabled"""
+        return self._socket.metrics()
+    def export_metrics(self) -> str:
+        """metrics() in the Prometheus text format"""
+        snapshot = self.metrics()
+        return "" if snapshot is None else prometheus_text([({}, snapshot)])
+
+    async def _offload(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    def _key_agreement(self, public_key: bytes, key_len: int) -> bytes:
+        from Crypto.PublicKey import ECC
+        from Crypto.Protocol import DH, KDF
+        from Crypto.Hash import SHA256
+        server_key = ECC.import_key(public_key)
+        return DH.key_agreement(static_priv=self._keypair, static_pub=server_key, kdf=functools.partial(KDF.HKDF, key_len=key_len, salt=self._session_nonce, hashmod=SHA256, num_keys=1, context=b''))
 
     def _update_task_done_callback(self, task):
         try:
@@ -52,6 +111,27 @@ class Hyphen0Client:
     async def mainloop(self):
         if not self._keypair:
             raise ValueError("set keypair before starting connection")
+        if self.RANK_ENCRYPTION_MODES:
+            self.ENCRYPTION_MODES = rank_modes(self.ENCRYPTION_MODES)
+        started = time.monotonic()
+        update_task = self._connect()
+        if await self._resume_handshake(update_task):
+            kind = "resumed"
+        elif self.FAST_HANDSHAKE:
+            kind = "fast"
+            await self._fast_handshake(update_task)
+        else:
+            kind = "legacy"
+            await self._legacy_handshake(update_task)
+        if self._socket._metrics is not None:
+            self._socket._metrics.inc(f"handshakes_{kind}")
+            self._socket._metrics.observe("handshake_seconds", time.monotonic() - started)
+        self._update_task = update_task
+        await self._call_hook("client_connected")
+        self._stage = "running"
+        return await self.work()
+
+    def _connect(self) -> asyncio.Task:
         self._stage = "connecting"
         try:
             self._socket.connect(self._host, self._port)
@@ -60,21 +140,91 @@ class Hyphen0Client:
             raise
         update_task = asyncio.create_task(self._serve_socket_update())
         update_task.add_done_callback(self._update_task_done_callback)
+        return update_task
+
+    async def _handshake_cancelled(self, update_task: asyncio.Task, cancel: HandshakeCancel):
+        await self._call_hook("crypt_modeselectfail")
+        update_task.cancel()
+        self._socket.close()
+        self._closed = True
+        await self._call_hook("client_killed")
+        raise ValueError(f"unable to handshake (server: {cancel.message.decode()})")
+
+    def _start_encryption(self, crypter_cls: type, session_key: bytes):
+        self._socket = CryptSocket(self._socket)
+        self._socket.set_encryption(crypter_cls(session_key))
+        self._resumption_secret = resumption_secret(session_key)
+
+    async def _resume_handshake(self, update_task: asyncio.Task) -> bool:
+        # like the fast handshake, but the session key comes from the ticket's secret instead of a key exchange.
+        # False if there's no usable ticket or the server turned it down, the full handshake goes on on the same connection
+        if self.ticket is None or not self.ticket.usable_for(self._host, self._port):
+            return False
+        ticket, self.ticket = self.ticket, None # tickets are good for one resumption only
+        self._stage = "handshaking_resume"
+        client_random = get_random_bytes(32)
+        self._socket.write_packet(HandshakeResume(version=PROTOCOL_VERSION, crypt_modes=[i.encode() for i in self.ENCRYPTION_MODES.keys()],
+                                                  ticket=ticket.ticket, client_random=client_random))
+        reply = await self._socket.wait_for_packet([HandshakeResumeAccept, HandshakeResumeReject, HandshakeCancel])
+        if isinstance(reply, HandshakeResumeReject):
+            return False
+        await self._call_hook("client_handshake")
+        if isinstance(reply, HandshakeCancel):
+            await self._handshake_cancelled(update_task, reply)
+
+        selected = reply.crypt_mode.decode()
+        await self._call_hook("crypt_modeselected", selected)
+        self._stage = "encrypting_start"
+        session_key = resumed_session_key(ticket.secret, reply.key_len, client_random, reply.server_random)
+        await self._call_hook("crypt_starting")
+
+        self._start_encryption(self.ENCRYPTION_MODES[selected], session_key)
+        self._stage = "encrypting_done"
+        await self._call_hook("crypt_complete")
+        self._socket.write_packet(HandshakeOK())
+        return True
+
+    async def _fast_handshake(self, update_task: asyncio.Task):
+        # mode list and public key go out in the first packet, the server answers with everything we need to start
+        # encrypting, and our first encrypted packet proves we got the same key. one round trip instead of five
+        self._stage = "handshaking_fast"
+        # our keypair stays the same from one connection to the next, so both ends salt the key with fresh randomness
+        client_random = get_random_bytes(32)
+        self._socket.write_packet(HandshakeFastInitiate(version=PROTOCOL_VERSION, crypt_modes=[i.encode() for i in self.ENCRYPTION_MODES.keys()],
+                                                        public_key=self._public_key, client_random=client_random))
+        accept_or_cancel = await self._socket.wait_for_packet([HandshakeFastAccept, HandshakeCancel])
+        await self._call_hook("client_handshake")
+        if isinstance(accept_or_cancel, HandshakeCancel):
+            await self._handshake_cancelled(update_task, accept_or_cancel)
+
+        self._stage = "encrypting_kex"
+        selected = accept_or_cancel.crypt_mode.decode()
+        await self._call_hook("crypt_modeselected", selected)
+        self._session_nonce = client_random + accept_or_cancel.salt
+        await self._call_hook("crypt_kexok")
+
+        self._stage = "encrypting_start"
+        session_key = await self._offload(self._key_agreement, accept_or_cancel.public_key, accept_or_cancel.key_len)
+        await self._call_hook("crypt_starting")
+
+        self._start_encryption(self.ENCRYPTION_MODES[selected], session_key)
+        self._stage = "encrypting_done"
+        await self._call_hook("crypt_complete")
+        self._socket.write_packet(HandshakeOK())
+
+    async def _legacy_handshake(self, update_task: asyncio.Task):
         self._stage = "handshaking"
-        self._socket.write_packet(HandshakeInitiate())
-        await self._socket.wait_for_packet(HandshakeConfirm)
+        self._socket.write_packet(HandshakeInitiate(version=PROTOCOL_VERSION))
+        confirm_or_cancel = await self._socket.wait_for_packet([HandshakeConfirm, HandshakeCancel])
         await self._call_hook("client_handshake")
+        if isinstance(confirm_or_cancel, HandshakeCancel):
+            await self._handshake_cancelled(update_task, confirm_or_cancel)
 
         self._stage = "encrypting_modeset"
         self._socket.write_packet(HandshakeCryptModesList(crypt_modes=[i.encode() for i in self.ENCRYPTION_MODES.keys()]))
         selected_or_cancel = (await self._socket.wait_for_packet([HandshakeCryptModeSelect, HandshakeCancel]))
         if isinstance(selected_or_cancel, HandshakeCancel):
-            await self._call_hook("crypt_modeselectfail")
-            update_task.cancel()
-            self._socket.close()
-            self._closed = True
-            await self._call_hook("client_killed")
-            raise ValueError(f"unable to handshake (server: {selected_or_cancel.message.decode()})")
+            await self._handshake_cancelled(update_task, selected_or_cancel)
         # update_task.cancel()
 
         self._stage = "encrypting_kex"
@@ -82,23 +232,20 @@ class Hyphen0Client:
         await self._call_hook("crypt_modeselected", selected)
         
         kex_server = await self._socket.wait_for_packet(HandshakeCryptKEXServer)
-        server_key = ECC.import_key(kex_server.public_key.decode())
-        await self._socket._write_packet(HandshakeCryptKEXClient(public_key=self._keypair.public_key().export_key(format='PEM').encode()))
-        self._session_nonce = kex_server.salt
+        client_random = get_random_bytes(32) # see _fast_handshake
+        await self._socket._write_packet(HandshakeCryptKEXClient(public_key=self._public_key, client_random=client_random))
+        self._session_nonce = client_random + kex_server.salt
         await self._call_hook("crypt_kexok")
 
         crypter_cls = self.ENCRYPTION_MODES[selected]
 
         self._stage = "encrypting_start"
-        session_key = DH.key_agreement(static_priv=self._keypair, static_pub=server_key, kdf=functools.partial(KDF.HKDF, key_len=kex_server.key_len, salt=self._session_nonce, hashmod=SHA256, num_keys=1, context=b''))
+        session_key = await self._offload(self._key_agreement, kex_server.public_key, kex_server.key_len)
         await self._call_hook("crypt_starting")
 
-        crypter = crypter_cls(session_key)
-
         await self._socket.wait_for_packet(HandshakeCryptOK)
         
-        self._socket = CryptSocket(self._socket)
-        self._socket.set_encryption(crypter)
+        self._start_encryption(crypter_cls, session_key)
         
         self._stage = "encrypting_test"
         test = random.randbytes(512)
@@ -111,50 +258,44 @@ class Hyphen0Client:
         self._stage = "encrypting_done"
         await self._call_hook("crypt_complete")
         self._socket.write_packet(HandshakeOK())
-        self._update_task = update_task
-        await self._call_hook("client_connected")
-        self._stage = "running"
-        return await self.work()
     def start(self):
         return asyncio.run(self.mainloop())
 
     async def close(self, message: str = "Disconnect by user", graceful: bool = True):
         if graceful:
             await self._socket._write_packet(Disconnect(message=message.encode()))
-        self._update_task.cancel()
+        if self._update_task: self._update_task.cancel()
         self._update_task = None
         self._socket.close()
         self._closed = True
 
     async def _serve_socket_update(self):
-        while True:
+        if self._closed: return
+        try:
+            await self._socket.pump()
+        except Exception as e:
             if self._closed: return
-            try:
-                await self._socket.update(0)
-            except Exception as e:
-                if not self._capture_errors: raise
-                print(f'[hyphen0] [CLIENT] {e}')
-                print(f"[hyphen0] [CLIENT] recv buffer", self._socket._recv_buffer)
-                for line in traceback.format_exc().split('\n'):
-                    print(f"[hyphen0] [CLIENT] {line}")
-                await self.close(graceful=False)
-                raise
-            await asyncio.sleep(0)
+            if not self._capture_errors: raise
+            log.exception("%s (%d bytes left in the receive buffer)", e, len(self._socket._recv_buffer))
+            await self.close(graceful=False)
+            raise
 
     def add_hook(self, event: str, name: str, callable):
         self._hooks[event] = self._hooks.get(event, {})
         self._hooks[event][name] = callable
 
     async def _call_hook(self, event: str, *args, **kwargs):
-        if self._trace_hooks:
-            print(f"[hyphen0] [CLIENT] {event} {args} {kwargs}")
+        if self._trace_hooks and hook_log.isEnabledFor(logging.DEBUG):
+            hook_log.debug("[CLIENT] %s %s %s", event, args, kwargs)
+        return await self._run_hook(event, *args, **kwargs)
+    async def _run_hook(self, event: str, *args, **kwargs):
         for callable in self._hooks.get(event, {}).values():
             if inspect.iscoroutinefunction(callable):
                 await callable(*args, **kwargs)
             else:
                 callable(*args, **kwargs)
         if not hasattr(self, f"_event_{event}"):
-            return # print(f"[hyphen0] [CLIENT] no hook")
+            return
         callable = getattr(self, f"_event_{event}")
         if inspect.iscoroutinefunction(callable):
             return await callable(*args, **kwargs)
@@ -166,11 +307,25 @@ class Hyphen0Client:
     async def work(self):
         while True:
             if self._closed: return
-            await asyncio.sleep(0)
-            pack = self._socket.read_packet()
-            if pack is None: continue
+            await asyncio.sleep(0) # see Hyphen0Server.work
+            try:
+                pack = await self._socket.next_packet()
+            except SocketClosed:
+                if self._closed: return
+                raise
             if isinstance(pack, Kick):
                 await self.close(graceful=False)
                 raise WereKicked(pack.message.decode())
-            await self._call_hook("packet_received", pack)
-            await self._call_hook(f"ptype_{type(pack).__name__}_received", pack)
\ No newline at end of file
+            if isinstance(pack, HandshakeTicket):
+                self.ticket = SessionTicket(self._host, self._port, pack.ticket, self._resumption_secret, time.time() + pack.lifetime)
+                await self._call_hook("ticket_received", self.ticket)
+                continue
+            self._trace_packet(pack)
+            await self._run_hook("packet_received", pack)
+            await self._run_hook(f"ptype_{type(pack).__name__}_received", pack)
+
+    def _trace_packet(self, packet: Packet):
+        if not self.PACKET_TRACE_SAMPLE: return
+        self._packets_seen += 1
+        if self._packets_seen % self.PACKET_TRACE_SAMPLE == 0 and packet_log.isEnabledFor(logging.DEBUG):
+            packet_log.debug("[CLIENT] received %r (1 in %d packets traced)", packet, self.PACKET_TRACE_SAMPLE)
\ No newline at end of file
@@ -1,7 +1,76 @@
+import itertools
+
+from Crypto.Random import get_random_bytes
+
 class _Crypter:
     _id: str = "_crypter"
+    overhead: int = 0 # how many bytes encryption adds to the data
+    decrypts_in_place: bool = False # whether decrypt_into() writes straight into out, rather than copying decrypt()'s result there
+    def set_serverbound(self, serverbound: bool):
+        # called by CryptSocket with the direction this crypter encrypts for, crypters that care should override it
+        pass
+
     def encrypt(self, data: bytes) -> bytes:
         raise NotImplementedError("tried to use raw _Crypter")
     
     def decrypt(self, crypted: bytes) -> bytes:
-        raise NotImplementedError("tried to use raw _Crypter")
\ No newline at end of file
+        raise NotImplementedError("tried to use raw _Crypter")
+
+    def encrypt_into(self, data: bytes, out: memoryview) -> int:
+        # crypters that can write into a preallocated buffer should override these two
+        crypted = self.encrypt(data)
+        out[0:len(crypted)] = crypted
+        return len(crypted)
+
+    def decrypt_into(self, crypted: bytes, out: memoryview) -> int:
+        data = self.decrypt(crypted)
+        out[0:len(data)] = data
+        return len(data)
+
+class _CounterNonceCrypter(_Crypter):
+    """AEAD crypter sending nonce + tag + ciphertext, where the nonce is a direction byte, a random per-crypter prefix
+    and a counter. Unique for the session without hitting the OS RNG per packet: both directions share the key, so the
+    direction byte keeps their nonces apart no matter what the prefixes come out as. Counters restart with every session,
+    which is only safe because every session gets a key of its own (both ends salt it with fresh randomness, see
+    HandshakeCryptKEXServer) and never relies on the prefix for that.
+    Subclasses set _new to a function making a cipher from a nonce= keyword, with encrypt/decrypt taking output="""
+    nonce_size: int = 12
+    tag_size: int = 16
+    overhead: int = 28
+    decrypts_in_place: bool = True
+    def __init__(self, new):
+        self._new = new
+        self._nonce_direction = b"\x00" # until set_serverbound(), for crypters used outside of a CryptSocket
+        self._nonce_prefix = get_random_bytes(self.nonce_size - 9)
+        self._nonce_counter = itertools.count()
+
+    def set_serverbound(self, serverbound: bool):
+        self._nonce_direction = b"\x01" if serverbound else b"\x02"
+
+    def _next_nonce(self) -> bytes:
+        return self._nonce_direction + self._nonce_prefix + next(self._nonce_counter).to_bytes(8, 'big')
+
+    def encrypt(self, data: bytes) -> bytes:
+        nonce = self._next_nonce()
+        ciphertext, tag = self._new(nonce=nonce).encrypt_and_digest(data)
+        return b''.join((nonce, tag, ciphertext))
+
+    def decrypt(self, crypted: bytes) -> bytes:
+        body = self.nonce_size + self.tag_size
+        return self._new(nonce=crypted[0:self.nonce_size]).decrypt_and_verify(crypted[body:], crypted[self.nonce_size:body])
+
+    def encrypt_into(self, data: bytes, out: memoryview) -> int:
+        nonce, body = self._next_nonce(), self.nonce_size + self.tag_size
+        cipher = self._new(nonce=nonce)
+        cipher.encrypt(data, output=out[body:body+len(data)])
+        out[0:self.nonce_size] = nonce
+        out[self.nonce_size:body] = cipher.digest()
+        return body + len(data)
+
+    def decrypt_into(self, crypted: bytes, out: memoryview) -> int:
+        body = self.nonce_size + self.tag_size
+        size = len(crypted) - body
+        cipher = self._new(nonce=crypted[0:self.nonce_size])
+        cipher.decrypt(crypted[body:], output=out[0:size])
+        cipher.verify(crypted[self.nonce_size:body])
+        return size
@@ -1,19 +1,24 @@
-from ._crypter import _Crypter
+from ._crypter import _Crypter, _CounterNonceCrypter
 
-from Crypto.Cipher import AES
+import functools
 
-class AESCrypter(_Crypter):
+class AESCrypter(_CounterNonceCrypter):
     _id: str = "aes"
+    # a 6 byte prefix, but like the other modes it doesn't have to keep sessions apart, their keys already differ
+    nonce_size: int = 15
+    overhead: int = 31
+    # OCB can't encrypt or decrypt into a buffer, CryptSocket decodes straight from what decrypt() returns instead
+    decrypts_in_place: bool = False
     def __init__(self, key: bytes):
+        from Crypto.Cipher import AES # loaded on first use rather than when hyphen0 is imported
         self._key = key
+        super().__init__(functools.partial(AES.new, key, AES.MODE_OCB))
 
-    def encrypt(self, data: bytes) -> bytes:
-        cipher = AES.new(self._key, AES.MODE_OCB)
-        ciphertext, tag = cipher.encrypt_and_digest(data)
-        return cipher.nonce + tag + ciphertext
-    
-    def decrypt(self, crypted: bytes) -> bytes:
-        nonce, tag, ciphertext = crypted[0:15], crypted[15:31], crypted[31:]
-        cipher = AES.new(self._key, AES.MODE_OCB, nonce=nonce)
-        return cipher.decrypt_and_verify(ciphertext, tag)
-    
+    def encrypt_into(self, data: bytes, out: memoryview) -> int:
+        nonce = self._next_nonce()
+        ciphertext, tag = self._new(nonce=nonce).encrypt_and_digest(data)
+        out[0:15] = nonce
+        out[15:31] = tag
+        out[31:31+len(ciphertext)] = ciphertext
+        return 31 + len(ciphertext)
+    decrypt_into = _Crypter.decrypt_into
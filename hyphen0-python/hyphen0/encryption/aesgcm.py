@@ -0,0 +1,10 @@
+from ._crypter import _CounterNonceCrypter
+
+import functools
+
+class AESGCMCrypter(_CounterNonceCrypter):
+    _id: str = "aes-gcm"
+    def __init__(self, key: bytes):
+        from Crypto.Cipher import AES # loaded on first use, see AESCrypter
+        self._key = key
+        super().__init__(functools.partial(AES.new, key, AES.MODE_GCM))
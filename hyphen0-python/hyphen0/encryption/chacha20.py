@@ -0,0 +1,10 @@
+from ._crypter import _CounterNonceCrypter
+
+import functools
+
+class ChaCha20Poly1305Crypter(_CounterNonceCrypter):
+    _id: str = "chacha20-poly1305"
+    def __init__(self, key: bytes):
+        from Crypto.Cipher import ChaCha20_Poly1305 # loaded on first use, see AESCrypter
+        self._key = key
+        super().__init__(functools.partial(ChaCha20_Poly1305.new, key=key))
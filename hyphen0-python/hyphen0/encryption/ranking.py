@@ -0,0 +1,22 @@
+import time
+
+from Crypto.Random import get_random_bytes
+
+from ._crypter import _Crypter
+
+def measure_throughput(crypter_cls: type[_Crypter], size: int = 1024, rounds: int = 64, key_len: int = 32) -> float:
+    """Bytes per second crypter_cls encrypts and decrypts packets of given size at on this machine"""
+    crypter = crypter_cls(get_random_bytes(key_len))
+    data = get_random_bytes(size)
+    crypted = memoryview(bytearray(size + crypter.overhead))
+    decrypted = memoryview(bytearray(size))
+    started = time.perf_counter()
+    for _ in range(rounds):
+        crypted_size = crypter.encrypt_into(data, crypted)
+        crypter.decrypt_into(crypted[:crypted_size], decrypted)
+    return size * rounds / (time.perf_counter() - started)
+
+def rank_modes(modes: dict[str, type[_Crypter]], key_len: int = 32) -> dict[str, type[_Crypter]]:
+    """Encryption modes reordered from fastest to slowest"""
+    throughput = {name: measure_throughput(crypter_cls, key_len=key_len) for name, crypter_cls in modes.items()}
+    return dict(sorted(modes.items(), key=lambda mode: throughput[mode[0]], reverse=True))
\ No newline at end of file
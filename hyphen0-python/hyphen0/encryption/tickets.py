@@ -0,0 +1,50 @@
+import time
+
+from Crypto.Random import get_random_bytes
+
+import hyphen0.primitives.basic as pack
+
+# nonce, issue time and resumption secret, then the GCM tag
+TICKET_SIZE = 12 + 8 + 32 + 16
+
+class SessionTicket:
+    """What a client needs to resume a session with the server that issued the ticket: the ticket itself,
+    opaque to the client, and the resumption secret both ends derived from the session it came from"""
+    def __init__(self, host: str, port: int, ticket: bytes, secret: bytes, expires: float):
+        self.host, self.port = host, port
+        self.ticket = ticket
+        self.secret = secret
+        self.expires = expires
+
+    def usable_for(self, host: str, port: int) -> bool:
+        return (self.host, self.port) == (host, port) and time.time() < self.expires
+
+def resumption_secret(session_key: bytes) -> bytes:
+    """Secret a session can later be resumed with, derived from its key so it never has to be sent"""
+    from Crypto.Protocol import KDF
+    from Crypto.Hash import SHA256
+    return KDF.HKDF(session_key, 32, b'', SHA256, 1, b'hyphen0 resumption')
+
+def resumed_session_key(secret: bytes, key_len: int, client_random: bytes, server_random: bytes) -> bytes:
+    """Fresh session key for a resumed session, both ends contribute randomness so it differs every time"""
+    from Crypto.Protocol import KDF
+    from Crypto.Hash import SHA256
+    return KDF.HKDF(secret, key_len, client_random + server_random, SHA256, 1, b'')
+
+def seal_ticket(ticket_key: bytes, secret: bytes) -> bytes:
+    from Crypto.Cipher import AES
+    nonce = get_random_bytes(12)
+    sealed, tag = AES.new(ticket_key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(pack.uint64.serialise((int(time.time()),))[1] + secret)
+    return nonce + sealed + tag
+
+def open_ticket(ticket_key: bytes, ticket: bytes) -> tuple[bytes, int, bytes]|None: # nonce (unique per ticket), issue time, secret
+    if len(ticket) != TICKET_SIZE:
+        return None
+    from Crypto.Cipher import AES
+    nonce, sealed, tag = ticket[:12], ticket[12:-16], ticket[-16:]
+    try:
+        opened = AES.new(ticket_key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(sealed, tag)
+    except ValueError:
+        return None
+    _, (issued,) = pack.uint64.deserialise_from(opened, 0)
+    return nonce, issued, opened[8:]
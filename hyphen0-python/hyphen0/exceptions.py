@@ -7,6 +7,9 @@ class SocketFlatlined(Exception):
 class SocketClosed(Exception):
     """Raised when client socket is closed without warning"""
 
+class QueueOverflow(Exception):
+    """Raised when socket packet queue overflows its limit under the "kick" policy"""
+
 class WereKicked(Exception):
     """Raised when remote server gracefully kicks the client"""
 class WereDisconnected(Exception):
@@ -0,0 +1,90 @@
+from bisect import bisect_left
+
+# upper bounds, in seconds, of the latency histogram buckets. the last bucket catches everything above them
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """Counts of observed values per bucket, Prometheus style"""
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def snapshot(self) -> dict:
+        cumulative, buckets = 0, []
+        for le, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            buckets.append((le, cumulative))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+class Metrics:
+    """Counters and latency histograms of a connection, or of a whole server. Whatever keeps one only pays for
+    updating it while metrics are enabled, everything else just checks it for None"""
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        self.histograms: dict[str, Histogram] = {}
+
+    def inc(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def merge(self, other: "Metrics"):
+        for name, value in other.counters.items():
+            self.inc(name, value)
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram(histogram.buckets)).merge(histogram)
+
+    def snapshot(self, gauges: dict[str, int|float]|None = None) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(gauges or {}),
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+def _labels(labels: dict[str, str], **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+def _number(value: int|float) -> str:
+    if value == float("inf"): return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+def prometheus_text(snapshots: list[tuple[dict[str, str], dict]], prefix: str = "hyphen0") -> str:
+    """Snapshots (each with the labels that tell it apart from the others) in the Prometheus text exposition format.
+    Counters get a _total suffix, histogram names are expected to carry their unit already"""
+    families: dict[str, tuple[str, list[str]]] = {} # name -> type, sample lines
+    for labels, snapshot in snapshots:
+        for name, value in snapshot["counters"].items():
+            families.setdefault(f"{prefix}_{name}_total", ("counter", []))[1].append(f"{prefix}_{name}_total{_labels(labels)} {_number(value)}")
+        for name, value in snapshot["gauges"].items():
+            families.setdefault(f"{prefix}_{name}", ("gauge", []))[1].append(f"{prefix}_{name}{_labels(labels)} {_number(value)}")
+        for name, histogram in snapshot["histograms"].items():
+            lines = families.setdefault(f"{prefix}_{name}", ("histogram", []))[1]
+            for le, count in histogram["buckets"]:
+                lines.append(f"{prefix}_{name}_bucket{_labels(labels, le=_number(le))} {count}")
+            lines.append(f"{prefix}_{name}_sum{_labels(labels)} {_number(histogram['sum'])}")
+            lines.append(f"{prefix}_{name}_count{_labels(labels)} {histogram['count']}")
+    out = []
+    for name, (kind, lines) in families.items():
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(lines)
+    return "\n".join(out) + "\n" if out else ""
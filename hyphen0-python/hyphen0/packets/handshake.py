@@ -2,11 +2,17 @@ from .packet import Packet, pack
 
 # pyright: reportInvalidTypeForm=false
 
+# sent by the client in whichever packet opens the handshake. a server that speaks another version cancels the
+# handshake instead of guessing, peers on different versions don't try to understand each other's packets
+PROTOCOL_VERSION = 2
+
 class HandshakeInitiate(Packet):
     """Sent by client to server immediately after connection.
-    Doesn't serve any purpose other than to verify that client is of ours protocol."""
+    Carries the protocol version, otherwise doesn't serve any purpose other than to verify that client is of ours protocol."""
     _serverbound: bool = True
 
+    version: pack.uint16
+
 class HandshakeConfirm(Packet):
     """Sent by server to client in response to HandshakeInitiate.
     Doesn't serve any purpose other than to verify that server is of ours protocol."""
@@ -37,16 +43,20 @@ class HandshakeCryptModeSelect(Packet):
     crypt_mode: pack.cstring
 
 class HandshakeCryptKEXServer(Packet):
-    """Sent by server to client during handshake and before encryption has been set up to exchange public key and session key parameters."""
+    """Sent by server to client during handshake and before encryption has been set up to exchange public key and session key parameters.
+    The public key is DER encoded, with a compressed point. The salt is fresh for every connection, and together with the client's
+    client_random salts the session key, so the same keypairs never end up with the same session key twice."""
     _serverbound: bool = False
     salt: pack.fixed(32)
     key_len: pack.uint16
-    public_key: pack.cstring
+    public_key: pack.bytestring
 
 class HandshakeCryptKEXClient(Packet):
-    """Sent by client to server during handshake and before encryption has been set up to exchange public key."""
+    """Sent by client to server during handshake and before encryption has been set up to exchange public key.
+    The public key is DER encoded, with a compressed point. client_random is fresh for every connection, see HandshakeCryptKEXServer."""
     _serverbound: bool = True
-    public_key: pack.cstring
+    public_key: pack.bytestring
+    client_random: pack.fixed(32)
 
 class HandshakeCryptOK(Packet):
     """Sent by server to client during handshake right before enabling encryption to notify the client to do the same."""
@@ -61,4 +71,56 @@ class HandshakeCryptTestPong(Packet):
     """Sent by server to client during handshake and after encryption has been enabled to test connectivity."""
     _serverbound: bool = False
 
-    test: pack.fixed(512)
\ No newline at end of file
+    test: pack.fixed(512)
+
+class HandshakeFastInitiate(Packet):
+    """Sent by client to server immediately after connection instead of HandshakeInitiate, to do the whole handshake in one round trip.
+    Carries the protocol version and what HandshakeCryptModesList and HandshakeCryptKEXClient would."""
+    _serverbound: bool = True
+
+    version: pack.uint16
+    crypt_modes: pack.array(pack.cstring)
+    public_key: pack.bytestring
+    client_random: pack.fixed(32)
+
+class HandshakeFastAccept(Packet):
+    """Sent by server to client in response to HandshakeFastInitiate, right before enabling encryption.
+    Carries what HandshakeCryptModeSelect and HandshakeCryptKEXServer would. The client answers with an encrypted HandshakeOK."""
+    _serverbound: bool = False
+
+    crypt_mode: pack.cstring
+    salt: pack.fixed(32)
+    key_len: pack.uint16
+    public_key: pack.bytestring
+
+class HandshakeResume(Packet):
+    """Sent by client to server immediately after connection instead of HandshakeInitiate, to resume an earlier session
+    with a ticket from HandshakeTicket instead of doing a key exchange. Carries the protocol version too."""
+    _serverbound: bool = True
+
+    version: pack.uint16
+    crypt_modes: pack.array(pack.cstring)
+    ticket: pack.bytestring
+    client_random: pack.fixed(32)
+
+class HandshakeResumeAccept(Packet):
+    """Sent by server to client in response to HandshakeResume if the ticket is good, right before enabling encryption.
+    The client answers with an encrypted HandshakeOK."""
+    _serverbound: bool = False
+
+    crypt_mode: pack.cstring
+    key_len: pack.uint16
+    server_random: pack.fixed(32)
+
+class HandshakeResumeReject(Packet):
+    """Sent by server to client in response to HandshakeResume if the ticket is invalid, expired or already used.
+    The client goes on with a HandshakeInitiate or HandshakeFastInitiate on the same connection."""
+    _serverbound: bool = False
+
+class HandshakeTicket(Packet):
+    """Sent by server to client, encrypted, after the handshake is done. Lets the client resume the session once
+    within `lifetime` seconds with HandshakeResume."""
+    _serverbound: bool = False
+
+    ticket: pack.bytestring
+    lifetime: pack.uint32
@@ -4,6 +4,8 @@ if sys.version_info.major == 3 and sys.version_info.minor >= 14:
 else:
     annotationlib_Format = None
 
+import struct
+
 import hyphen0.primitives.basic as pack
 from hyphen0.primitives._serialisable import _Serialisable
 from hyphen0.exceptions import IncompleteData
@@ -17,6 +19,24 @@ REGISTERED_PACKETS = {
 
 pid_prim = pack.uint8
 
+def _compile_fields(fields: list[tuple[str, _Serialisable]]) -> list[tuple]:
+    """Turns a packet field list into codec steps, merging runs of fixed-size struct fields into a single struct.Struct.
+    Each step is either ((names...), struct.Struct) or (name, _Serialisable)."""
+    steps = []
+    run_names, run_fmt = [], ""
+    for fname, ftype in fields:
+        if isinstance(ftype, pack._StructPrimitive) and ftype.fmt[0] not in "@=<>!":
+            run_names.append(fname)
+            run_fmt += ftype.fmt
+            continue
+        if run_names:
+            steps.append((tuple(run_names), struct.Struct("="+run_fmt)))
+            run_names, run_fmt = [], ""
+        steps.append((fname, ftype))
+    if run_names:
+        steps.append((tuple(run_names), struct.Struct("="+run_fmt)))
+    return steps
+
 class PacketMeta(type):
     _next_serverbound_pid: int = 0
     _next_clientbound_pid: int = 0
@@ -40,6 +60,7 @@ class PacketMeta(type):
             if not isinstance(ftype, _Serialisable) and not issubclass(ftype, pack.cstruct):
                 raise ValueError("field in Packet is not a _Serialisable")
             namespace['_fields'].append((fname, ftype))
+        namespace['_codec'] = _compile_fields(namespace['_fields'])
         namespace['_pid'] = cls._next_serverbound_pid if serverbound else cls._next_clientbound_pid
         cls._next_serverbound_pid += 1 if serverbound else 0
         cls._next_clientbound_pid += 0 if serverbound else 1
@@ -56,6 +77,7 @@ class Packet(_Serialisable, metaclass=PacketMeta):
     _pid: int
     _serverbound: bool
     _fields: tuple[str, _Serialisable]
+    _codec: list[tuple]
 
     def __init__(self, **kwargs):
         for k,v in kwargs.items():
@@ -81,25 +103,33 @@ class Packet(_Serialisable, metaclass=PacketMeta):
     def serialise(self, serverbound: bool) -> bytes:
         if self._serverbound != serverbound:
             raise ValueError(f"attempting to serialise packet ({type(self).__name__}) for {'non-' if not serverbound else ''}serverbound sending")
-        raw = b''
-        for fname, ftype in self._fields:
-            _, ser = ftype.serialise((getattr(self, fname),))
-            raw += ser
-        return raw
+        parts = []
+        for names, step in self._codec:
+            if isinstance(step, struct.Struct):
+                parts.append(step.pack(*[getattr(self, fname) for fname in names]))
+                continue
+            parts.append(step.serialise((getattr(self, names),))[1])
+        return b''.join(parts)
     @staticmethod
     def deserialise(raw, serverbound: bool) -> tuple[int, object]: # consumed, deserialised packet
-        cns = 0
-        _, (pid,) = pid_prim.deserialise(raw)
+        return Packet.deserialise_from(raw, 0, serverbound)
+    @staticmethod
+    def deserialise_from(raw, offset: int, serverbound: bool) -> tuple[int, object]: # new offset, deserialised packet
+        _, (pid,) = pid_prim.deserialise_from(raw, offset)
         packet_cls = Packet.find_by_pid(pid, serverbound)
         fields = {}
-        for fname, ftype in packet_cls._fields:
-            if raw == b'':
+        for names, step in packet_cls._codec:
+            if isinstance(step, struct.Struct):
+                if len(raw) - offset < step.size:
+                    raise IncompleteData()
+                fields.update(zip(names, step.unpack_from(raw, offset)))
+                offset += step.size
+                continue
+            if offset >= len(raw):
                 raise IncompleteData()
-            consumed, (decoded,) = ftype.deserialise(raw)
-            cns += consumed
-            raw = raw[consumed:]
-            fields[fname] = decoded
-        return cns, packet_cls(**fields)
+            offset, (decoded,) = step.deserialise_from(raw, offset)
+            fields[names] = decoded
+        return offset, packet_cls(**fields)
 
 class HeartbeatClientbound(Packet):
     _serverbound: bool = False
@@ -5,4 +5,8 @@ class _Serialisable:
     def serialise(self, *data: any) -> bytes:
         raise ValueError("attempted to use raw _Serialisable")
     def deserialise(self, raw: bytes) -> any:
-        raise ValueError("attempted to use raw _Serialisable")
\ No newline at end of file
+        raise ValueError("attempted to use raw _Serialisable")
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        # fallback for serialisables that only know how to decode from the start of a buffer
+        consumed, decoded = self.deserialise(bytes(buf[offset:]))
+        return offset + consumed, decoded
\ No newline at end of file
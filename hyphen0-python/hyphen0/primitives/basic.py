@@ -1,4 +1,5 @@
 import struct
+from array import array as _typed_array
 
 import sys
 if sys.version_info.major == 3 and sys.version_info.minor >= 14:
@@ -12,17 +13,20 @@ from hyphen0.exceptions import IncompleteData
 class _StructPrimitive(_Serialisable):
     def __init__(self, fmt: str):
         self.fmt = fmt
-        self.size = struct.calcsize(self.fmt)
+        self._struct = struct.Struct(self.fmt)
+        self.size = self._struct.size
 
     def __repr__(self):
         return f"<StructPrimitive fmt={repr(self.fmt)}>"
 
     def serialise(self, data: tuple[any]) -> tuple[int, bytes]: # size, raw
-        return self.size, struct.pack(self.fmt, *data)
+        return self.size, self._struct.pack(*data)
     def deserialise(self, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
-        if len(raw) < self.size:
+        return self.deserialise_from(raw, 0)
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        if len(buf) - offset < self.size:
             raise IncompleteData()
-        return self.size, (struct.unpack(self.fmt, raw[0:self.size]))
+        return offset + self.size, self._struct.unpack_from(buf, offset)
 
 uint8   = _StructPrimitive("B")
 uint16  = _StructPrimitive("H")
@@ -34,6 +38,16 @@ int32   = _StructPrimitive("i")
 int64   = _StructPrimitive("q")
 boolean = _StructPrimitive("?")
 
+def _find_null(buf, offset: int) -> int:
+    if not isinstance(buf, memoryview):
+        return buf.find(b'\0', offset)
+    # memoryviews can't be searched, so look through them in small copied blocks instead of copying the whole tail
+    for start in range(offset, len(buf), 256):
+        found = bytes(buf[start:start+256]).find(b'\0')
+        if found != -1:
+            return start + found
+    return -1
+
 class _NullTerminatedStringPrimitive(_Serialisable):
     def __repr__(self):
         return f"<NullTerminatedStringPrimitive>"
@@ -48,48 +62,96 @@ class _NullTerminatedStringPrimitive(_Serialisable):
             raise ValueError(f'NullTerminatedStringPrimitive used to encode bytestring containing NULL')
         return len(data)+1, data+b'\0'
     def deserialise(self, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
-        if not b'\0' in raw:
+        return self.deserialise_from(raw, 0)
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        end = _find_null(buf, offset)
+        if end == -1:
             raise IncompleteData()
-        data = raw.split(b'\0')[0]
-        return len(data)+1, (data,)
+        return end + 1, (bytes(buf[offset:end]),)
 
 cstring = _NullTerminatedStringPrimitive()
 
+class _SizedBytesPrimitive(_Serialisable):
+    """Binary-safe bytestring of up to 65535 bytes, prefixed with its length"""
+    def __repr__(self):
+        return f"<SizedBytesPrimitive>"
+
+    def serialise(self, data: tuple[any]) -> tuple[int, bytes]: # size, raw
+        if len(data) > 1:
+            raise ValueError(f'SizedBytesPrimitive expects only a single bytestring, got {len(data)} values')
+        data = data[0]
+        if not isinstance(data, bytes):
+            raise ValueError(f'SizedBytesPrimitive expects a bytestring, got {type(data).__name__}')
+        if len(data) > 0xFFFF:
+            raise ValueError(f'SizedBytesPrimitive expects at most 65535 bytes, got {len(data)}')
+        return 2+len(data), uint16.serialise((len(data),))[1] + data
+    def deserialise(self, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
+        return self.deserialise_from(raw, 0)
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        offset, (size,) = uint16.deserialise_from(buf, offset)
+        if len(buf) - offset < size:
+            raise IncompleteData()
+        return offset + size, (bytes(buf[offset:offset+size]),)
+
+bytestring = _SizedBytesPrimitive()
+
 class _ArrayPrimitive(_Serialisable):
-    def __init__(self, ftype: _Serialisable):
+    def __init__(self, ftype: _Serialisable, buffer: bool = False):
         if ftype == _Serialisable:
             raise ValueError("field in Packet is a raw _Serialisable")
         if not isinstance(ftype, _Serialisable):
             raise ValueError("field in Packet is not a _Serialisable")
         self.type = ftype
+        # arrays of plain numbers are packed and unpacked with a single struct call instead of per element
+        self._bulk = ftype.fmt if isinstance(ftype, _StructPrimitive) and len(ftype.fmt) == 1 else None
+        # buffer arrays decode into array.array (usable by numpy.frombuffer) and accept one when serialising
+        self.buffer = buffer
+        if buffer and (self._bulk is None or self._bulk not in "bBhHiIqQ"):
+            raise ValueError(f'Array can only use buffers for integer primitives, got {ftype}')
     def __repr__(self=None):
         if not self: return f"<Array of Unassigned>"
         return f"<Array of {self.type}>"
 
     def serialise(self, data: tuple[any]) -> tuple[int, bytes]: # size, raw
-        raw = b''
         if len(data) > 1:
             raise ValueError(f'Array expects only a single list of {self.type}, got {len(data)} values')
         data = data[0]
+        if self.buffer and isinstance(data, _typed_array):
+            if data.typecode != self._bulk:
+                raise ValueError(f'Array expects an array.array of typecode {repr(self._bulk)}, got {repr(data.typecode)}')
+            raw = uint16.serialise((len(data),))[1] + data.tobytes()
+            return len(raw), raw
         if not isinstance(data, list):
             raise ValueError(f'Array expects a list of {self.type}, got {type(data).__name__}')
+        if self._bulk is not None:
+            raw = uint16.serialise((len(data),))[1] + struct.pack(f"={len(data)}{self._bulk}", *data)
+            return len(raw), raw
+        parts = [uint16.serialise((len(data),))[1]]
         for elem in data:
             size, serialised = self.type.serialise((elem,))
-            raw += serialised # uint32.serialise(size)+serialised
-        raw = uint16.serialise((len(data),))[1]+raw
+            parts.append(serialised) # uint32.serialise(size)+serialised
+        raw = b''.join(parts)
         return len(raw), raw
     def deserialise(self, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
-        consumed_total = 0
-        cns, (count,) = uint16.deserialise(raw)
-        consumed_total, raw = consumed_total + cns, raw[cns:]
+        return self.deserialise_from(raw, 0)
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        offset, (count,) = uint16.deserialise_from(buf, offset)
+        if self._bulk is not None:
+            size = count * self.type.size
+            if len(buf) - offset < size:
+                raise IncompleteData()
+            if self.buffer:
+                arr = _typed_array(self._bulk)
+                arr.frombytes(buf[offset:offset+size])
+                return offset + size, (arr,)
+            return offset + size, (list(struct.unpack_from(f"={count}{self._bulk}", buf, offset)),)
         lst = []
         for i in range(count):
-            if raw == b'':
+            if offset >= len(buf):
                 raise IncompleteData()
-            cns, (elem,) = self.type.deserialise(raw)
-            consumed_total, raw = consumed_total + cns, raw[cns:]
+            offset, (elem,) = self.type.deserialise_from(buf, offset)
             lst.append(elem)
-        return consumed_total, (lst,)
+        return offset, (lst,)
 
 array = _ArrayPrimitive
 
@@ -111,9 +173,11 @@ class _FixedPrimitive(_Serialisable):
             raise ValueError(f'FixedPrimitive expects only a single bytestring of size {self.size}, got {len(data)}')
         return self.size, data
     def deserialise(self, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
-        if len(raw) < self.size:
+        return self.deserialise_from(raw, 0)
+    def deserialise_from(self, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
+        if len(buf) - offset < self.size:
             raise IncompleteData()
-        return self.size, (raw[0:self.size],)
+        return offset + self.size, (bytes(buf[offset:offset+self.size]),)
 
 fixed = _FixedPrimitive
 
@@ -166,23 +230,21 @@ class _CStructPrimitive(_Serialisable, metaclass=_CStructPrimitiveMeta):
         if not isinstance(data, _CStructPrimitive):
             raise ValueError(f'CStructPrimitive expects only a single struct, got {type(data).__name__}')
 
-        raw = b''
-        for fname, ftype in data._fields:
-            _, ser = ftype.serialise((getattr(data, fname),))
-            raw += ser
+        raw = b''.join(ftype.serialise((getattr(data, fname),))[1] for fname, ftype in data._fields)
         return len(raw), raw
 
     @classmethod
     def deserialise(cls, raw: bytes) -> tuple[int, tuple[any]]: # consumed, (decoded,)
+        return cls.deserialise_from(raw, 0)
+
+    @classmethod
+    def deserialise_from(cls, buf, offset: int = 0) -> tuple[int, tuple[any]]: # new offset, (decoded,)
         fields = {}
-        cns = 0
         for fname, ftype in cls._fields:
-            if raw == b'':
+            if offset >= len(buf):
                 raise IncompleteData()
-            consumed, (decoded,) = ftype.deserialise(raw)
-            cns += consumed
-            raw = raw[consumed:]
+            offset, (decoded,) = ftype.deserialise_from(buf, offset)
             fields[fname] = decoded
-        return cns, (cls(**fields),)
+        return offset, (cls(**fields),)
 
 cstruct = _CStructPrimitive
\ No newline at end of file
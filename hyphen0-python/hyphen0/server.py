@@ -1,60 +1,158 @@
+import os
+import time
+import signal
+import socket
 import asyncio
 import random
 import functools
-import traceback
 import inspect
+import logging
+from concurrent.futures import Executor
+from .socket.basicsocket import BasicSocket
 from .socket.protosocket import ProtoSocket
 from .socket.cryptsocket import CryptSocket
 
-from .packets.packet import Kick, Disconnect
-from .exceptions import WereDisconnected, SocketClosed
+from .packets.packet import Packet, Kick, Disconnect, pack
+from .exceptions import WereDisconnected, SocketClosed, QueueOverflow
 
 from .packets.handshake import HandshakeInitiate, HandshakeConfirm, HandshakeCancel, HandshakeOK, \
                                HandshakeCryptModesList, HandshakeCryptModeSelect, HandshakeCryptOK, \
                                HandshakeCryptKEXClient, HandshakeCryptKEXServer, \
-                               HandshakeCryptTestPing, HandshakeCryptTestPong
+                               HandshakeCryptTestPing, HandshakeCryptTestPong, \
+                               HandshakeFastInitiate, HandshakeFastAccept, \
+                               HandshakeResume, HandshakeResumeAccept, HandshakeResumeReject, HandshakeTicket, \
+                               PROTOCOL_VERSION
 
 from .encryption.aes import AESCrypter
+from .encryption.aes256 import AES256Crypter
+from .encryption.aesgcm import AESGCMCrypter
+from .encryption.chacha20 import ChaCha20Poly1305Crypter
+from .encryption.ranking import rank_modes
+from .encryption.tickets import resumption_secret, resumed_session_key, seal_ticket, open_ticket
 
 from .stegano._layer import SteganoLayer
+from .metrics import Metrics, prometheus_text
 
 from Crypto.Random import get_random_bytes
-from Crypto.PublicKey import ECC
-from Crypto.Protocol import DH
-from Crypto.Protocol import KDF
-from Crypto.Hash import SHA256
+
+log = logging.getLogger(__name__)
+# hook events, with _trace_hooks set, and a sample of received packets, see PACKET_TRACE_SAMPLE. both at DEBUG level
+hook_log = logging.getLogger("hyphen0.hooks")
+packet_log = logging.getLogger("hyphen0.packets")
+
+# kinds of messages relayed between serve(workers=N) worker processes
+WORKER_BROADCAST = 0
+WORKER_MESSAGE = 1
+WORKER_TICKET_USED = 2
 
 class Hyphen0Server:
     _trace_hooks: bool = True
     _capture_errors: bool = True
 
-    ENCRYPTION_MODES = {'aes': AESCrypter}
+    # in order of preference, reordered by measured throughput on mainloop() start if RANK_ENCRYPTION_MODES is set
+    ENCRYPTION_MODES = {'chacha20-poly1305': ChaCha20Poly1305Crypter, 'aes-gcm': AESGCMCrypter, 'aes': AESCrypter, 'aes256': AES256Crypter}
+    RANK_ENCRYPTION_MODES = True
 
     KEY_LENGTH = 32
+    # one in how many received packets makes it to the packet trace, 0 turns it off. packets don't go to the hook trace
+    PACKET_TRACE_SAMPLE = 100
+    # seconds a resumption ticket stays valid for, 0 stops issuing them
+    TICKET_LIFETIME = 3600
 
     def __init__(self, host: str, port: int, steganolayer: SteganoLayer|None = None):
         self._host, self._port = host, port
         self._socket = ProtoSocket(False, 10, 5, steganolayer)
         self._socket.bind(host, port)
         self._keypair = None
-        self._session_nonce = get_random_bytes(32)
+        self._public_key = None
+        # tickets are sealed with a key only this server (and its workers) know, and each can be redeemed once
+        self._ticket_key = get_random_bytes(32)
+        self._used_tickets = {} # ticket nonce -> when it would have expired anyway
+        self._used_tickets_prune_at = 1024
         self._connected_clients = {}
         self._client_tasks = {}
         self._hooks = {}
+        self._executor = None
+        self._worker_link = None
+        self._metrics = None # handshakes, plus everything connections that are gone counted
+        self._packets_seen = 0
 
     def set_keypair(self, keypair):
+        from Crypto.PublicKey import ECC # the key maths is only loaded once it's needed, importing hyphen0 stays cheap
         if not isinstance(keypair, ECC.EccKey):
             raise ValueError("keypair should be ECCKey")
         self._keypair = keypair
+        self._public_key = keypair.public_key().export_key(format='DER', compress=True)
+
+    def set_queue_limits(self, inbound: int|None = None, outbound: int|None = None, policy: str = "drain"):
+        """Packet queue limits for clients accepted from now on, see ProtoSocket.set_queue_limits"""
+        self._socket.set_queue_limits(inbound, outbound, policy)
+
+    def set_executor(self, executor: Executor|None, threshold: int = 65536):
+        """Runs key agreement, and crypto and stegano work on payloads of at least `threshold` bytes, on `executor`
+        instead of the event loop thread. Without one, key agreement still runs on the loop's default executor.
+        See ProtoSocket.set_executor"""
+        self._executor = executor
+        self._socket.set_executor(executor, threshold)
+    def enable_metrics(self, enabled: bool = True):
+        """Starts (or stops) counting traffic, handshakes and crypto time, per connection and server-wide, see metrics().
+        Only clients accepted from now on are counted. With several workers, each one counts its own clients"""
+        self._metrics = Metrics() if enabled else None
+        self._socket.enable_metrics(enabled)
+    def metrics(self) -> dict|None:
+        """Server-wide snapshot: everything every connection counted so far, with queue depths summed up
+        over the connected ones. None if metrics aren't enabled"""
+        if self._metrics is None:
+            return None
+        merged, gauges = Metrics(), {"connections": 0}
+        merged.merge(self._metrics)
+        for client in self._client_tasks:
+            if not isinstance(client, ProtoSocket) or client._metrics is None: continue
+            self._merge_client_metrics(merged, client)
+            gauges["connections"] += 1
+            for name, value in client.queue_stats().items():
+                if name.endswith("_dropped") or name.endswith("_peak"): continue
+                gauges[name] = gauges.get(name, 0) + value
+        return merged.snapshot(gauges)
+    def _merge_client_metrics(self, into: Metrics, client: ProtoSocket):
+        into.merge(client._metrics)
+        stats = client.queue_stats()
+        into.inc("inbound_dropped", stats["inbound_dropped"])
+        into.inc("outbound_dropped", stats["outbound_dropped"])
+    def client_metrics(self) -> dict[str, dict]:
+        """Snapshot of every connected client that's being counted, by address"""
+        return {client.getnicename(): client.metrics() for client in self._client_tasks
+                if isinstance(client, ProtoSocket) and client._metrics is not None}
+    def export_metrics(self, per_connection: bool = False) -> str:
+        """metrics() in the Prometheus text format, plus every connection labelled with its address
+        (as hyphen0_connection_*) if `per_connection` is set"""
+        if self._metrics is None:
+            return ""
+        text = prometheus_text([({}, self.metrics())])
+        if per_connection:
+            text += prometheus_text([({"peer": peer}, snapshot) for peer, snapshot in self.client_metrics().items()], "hyphen0_connection")
+        return text
+
+    async def _offload(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+    def _key_agreement(self, public_key: bytes, salt: bytes) -> bytes:
+        from Crypto.PublicKey import ECC
+        from Crypto.Protocol import DH, KDF
+        from Crypto.Hash import SHA256
+        client_key = ECC.import_key(public_key)
+        return DH.key_agreement(static_priv=self._keypair, static_pub=client_key, kdf=functools.partial(KDF.HKDF, key_len=self.KEY_LENGTH, salt=salt, hashmod=SHA256, num_keys=1, context=b''))
 
     async def mainloop(self):
         if not self._keypair:
             raise ValueError("set keypair before starting connection")
-        print(f"[hyphen0] serving on {self._host}:{self._port}")
+        if self.RANK_ENCRYPTION_MODES:
+            self.ENCRYPTION_MODES = rank_modes(self.ENCRYPTION_MODES, self.KEY_LENGTH)
+        log.info("serving on %s:%s", self._host, self._port)
         while True:
             client, addr = await self._socket.accept()
             if self._socket.is_closed(): return
-            print(f"[hyphen0] new client connected: {addr[0]}:{addr[1]}")
+            log.info("new client connected: %s:%s", addr[0], addr[1])
+            if self._metrics is not None: self._metrics.inc("connections_accepted")
             task = asyncio.create_task(self._client_connected(client))
             task.add_done_callback(self._client_done_callback)
             self._client_tasks[task] = client
@@ -67,8 +165,125 @@ class Hyphen0Server:
             # await client.close()
         self._socket.close()
 
-    def serve(self):
-        return asyncio.run(self.mainloop())
+    def serve(self, workers: int = 1):
+        """Serves until interrupted. With workers > 1, forks that many worker processes with their own event loops, each
+        listening on the port through SO_REUSEPORT (or all accepting from this socket, where that's unavailable).
+        This process stays around to relay broadcasts and publish()ed messages between them"""
+        if workers <= 1:
+            return asyncio.run(self.mainloop())
+        if not hasattr(os, "fork"):
+            raise OSError("serving with several workers needs os.fork()")
+        if self.RANK_ENCRYPTION_MODES:
+            # ranked once up front, so every worker prefers the same modes
+            self.ENCRYPTION_MODES = rank_modes(self.ENCRYPTION_MODES, self.KEY_LENGTH)
+            self.RANK_ENCRYPTION_MODES = False
+
+        listeners = [None] * workers
+        if hasattr(socket, "SO_REUSEPORT"):
+            # every socket on the port has to have SO_REUSEPORT set, ours doesn't
+            self._socket.close()
+            listeners = []
+            for _ in range(workers):
+                listener = BasicSocket()
+                listener.bind(self._host, self._port, reuse_port=True)
+                listeners.append(listener)
+        pids, links = [], []
+        for listener in listeners:
+            link, worker_link = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                link.close()
+                for other in links: other.close()
+                for other in listeners:
+                    if other is not None and other is not listener: other.close()
+                self._run_worker(listener, worker_link)
+            worker_link.close()
+            pids.append(pid)
+            links.append(link)
+        for listener in listeners:
+            if listener is not None: listener.close()
+
+        try:
+            asyncio.run(self._relay(links))
+        finally:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError: pass
+            for pid in pids:
+                os.waitpid(pid, 0)
+            self._socket.close()
+
+    def _run_worker(self, listener: BasicSocket|None, link: socket.socket):
+        # never returns, the worker process ends right here
+        code = 0
+        try:
+            if listener is not None:
+                self._socket.set_socket(listener._socket)
+            asyncio.run(self._worker_mainloop(link))
+        except KeyboardInterrupt: pass
+        except BaseException:
+            log.exception("worker %d died", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    async def _worker_mainloop(self, link: socket.socket):
+        reader, self._worker_link = await asyncio.open_connection(sock=link)
+        serving = asyncio.create_task(self.mainloop())
+        relaying = asyncio.create_task(self._worker_relay(reader))
+        done, _ = await asyncio.wait((serving, relaying), return_when=asyncio.FIRST_COMPLETED)
+        for task in (serving, relaying):
+            task.cancel()
+        await self.close()
+        if serving in done:
+            serving.result()
+
+    async def _read_relayed(self, reader: asyncio.StreamReader) -> bytes|None:
+        try:
+            header = await reader.readexactly(4)
+            _, (size,) = pack.uint32.deserialise_from(header, 0)
+            return header + await reader.readexactly(size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    async def _relay(self, links: list[socket.socket]):
+        # every message a worker sends goes out to all the other workers, until they're all gone or we get told to stop
+        streams = [await asyncio.open_connection(sock=link) for link in links]
+        async def forward(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            while (message := await self._read_relayed(reader)) is not None:
+                for _, other in streams:
+                    if other is not writer and not other.is_closing(): other.write(message)
+        relaying = asyncio.gather(*(forward(reader, writer) for reader, writer in streams))
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, relaying.cancel)
+        try:
+            await relaying
+        except asyncio.CancelledError: pass
+        for _, writer in streams:
+            writer.close()
+
+    async def _worker_relay(self, reader: asyncio.StreamReader):
+        # returns once the supervising process goes away
+        while (message := await self._read_relayed(reader)) is not None:
+            kind, payload = message[4], message[5:]
+            if kind == WORKER_BROADCAST:
+                self._broadcast_serialised(payload)
+            elif kind == WORKER_MESSAGE:
+                await self._call_hook(None, "worker_message", payload)
+            elif kind == WORKER_TICKET_USED:
+                _, (expires,) = pack.uint64.deserialise_from(payload, 0)
+                self._remember_ticket(payload[8:], expires)
+
+    def _publish(self, kind: int, payload: bytes):
+        if self._worker_link is None or self._worker_link.is_closing(): return
+        self._worker_link.writelines((pack.uint32.serialise((1 + len(payload),))[1], bytes((kind,)), payload))
+
+    def publish(self, data: bytes):
+        """Hands data to every other worker process, where it fires the worker_message hook with it.
+        Does nothing unless serving with several workers"""
+        self._publish(WORKER_MESSAGE, data)
 
     def _client_done_callback(self, task):
         try:
@@ -77,10 +292,9 @@ class Hyphen0Server:
         except SocketClosed: pass
         except WereDisconnected: pass
         except Exception as e:
-            print(f"[hyphen0] [SERVER] Client task exited with exception")
-            for chunk in traceback.format_exception(e):
-                for line in chunk[:-1].split("\n"):
-                    print(f"[hyphen0] [SERVER] {line}")
+            log.error("client task exited with exception", exc_info=e)
+        if self._metrics is not None and self._client_tasks[task]._metrics is not None:
+            self._merge_client_metrics(self._metrics, self._client_tasks[task]) # kept once the connection is gone
         self._client_tasks[task].close()
         del self._client_tasks[self._client_tasks[task]]
         del self._client_tasks[task]
@@ -91,35 +305,133 @@ class Hyphen0Server:
         except asyncio.CancelledError: pass
     
     async def _client_connected(self, client: ProtoSocket):
+        started = time.monotonic()
         update_task = asyncio.create_task(self._serve_client_update(client))
         update_task.add_done_callback(self._update_task_done_callback)
-        await client.wait_for_packet(HandshakeInitiate)
-        client.write_packet(HandshakeConfirm())
-        await self._call_hook(client, "client_handshake")
+        initiate = await client.wait_for_packet([HandshakeInitiate, HandshakeFastInitiate, HandshakeResume])
+        if isinstance(initiate, HandshakeResume) and initiate.version == PROTOCOL_VERSION:
+            secret = self._redeem_ticket(initiate.ticket)
+            if secret is None:
+                # the client goes on with a full handshake on the same connection
+                client.write_packet(HandshakeResumeReject())
+                initiate = await client.wait_for_packet([HandshakeInitiate, HandshakeFastInitiate])
+        if initiate.version != PROTOCOL_VERSION:
+            established = await self._version_mismatch(client, initiate.version, update_task)
+        elif isinstance(initiate, HandshakeResume):
+            kind, established = "resumed", await self._resume_handshake(client, initiate, secret, update_task)
+        elif isinstance(initiate, HandshakeFastInitiate):
+            kind, established = "fast", await self._fast_handshake(client, initiate, update_task)
+        else:
+            kind, established = "legacy", await self._legacy_handshake(client, update_task)
+        if established is None:
+            if self._metrics is not None: self._metrics.inc("handshakes_failed")
+            return
+        if self._metrics is not None:
+            self._metrics.inc(f"handshakes_{kind}")
+            self._metrics.observe("handshake_seconds", time.monotonic() - started)
+        client, session_key = established
+        await self._call_hook(client, "crypt_complete")
+        self._connected_clients[client.getnicename()] = {'upd': update_task, 'sock': client}
+        if self.TICKET_LIFETIME:
+            client.write_packet(HandshakeTicket(ticket=seal_ticket(self._ticket_key, resumption_secret(session_key)), lifetime=self.TICKET_LIFETIME))
+        await self._call_hook(client, "client_connected")
+        return await self.work(client)
 
-        modeslist = (await client.wait_for_packet(HandshakeCryptModesList)).crypt_modes
-        shared_modes = [i.decode() for i in (set([i.encode() for i in self.ENCRYPTION_MODES.keys()]) & set(modeslist))]
+    async def _version_mismatch(self, client: ProtoSocket, version: int, update_task: asyncio.Task) -> None:
+        await self._call_hook(client, "client_versionmismatch", version)
+        update_task.cancel()
+        await client._write_packet(HandshakeCancel(message=f'unsupported protocol version {version}, server speaks {PROTOCOL_VERSION}'.encode()))
+        await self._call_hook(client, "client_killed")
+        client.close()
+        return None
+
+    async def _select_mode(self, client: ProtoSocket, modeslist: list[bytes], update_task: asyncio.Task) -> str|None:
+        shared_modes = [mode for mode in self.ENCRYPTION_MODES.keys() if mode.encode() in modeslist]
         if len(shared_modes) == 0:
             await self._call_hook(client, "crypt_modeselectfail")
             update_task.cancel()
             await client._write_packet(HandshakeCancel(message=b'no shared encryption modes found'))
             await self._call_hook(client, "client_killed")
             client.close()
-            return
+            return None
         await self._call_hook(client, "crypt_modeselected", shared_modes[0])
-        client.write_packet(HandshakeCryptModeSelect(crypt_mode=shared_modes[0].encode()))
+        return shared_modes[0]
+
+    def _remember_ticket(self, ticket_id: bytes, expires: float):
+        self._used_tickets[ticket_id] = expires
+        if len(self._used_tickets) >= self._used_tickets_prune_at:
+            now = time.time()
+            self._used_tickets = {used: until for used, until in self._used_tickets.items() if until > now}
+            self._used_tickets_prune_at = max(1024, len(self._used_tickets) * 2)
+    def _redeem_ticket(self, ticket: bytes) -> bytes|None:
+        opened = open_ticket(self._ticket_key, ticket)
+        if opened is None:
+            return None
+        ticket_id, issued, secret = opened
+        expires = issued + self.TICKET_LIFETIME
+        if time.time() >= expires or ticket_id in self._used_tickets:
+            return None
+        self._remember_ticket(ticket_id, expires)
+        self._publish(WORKER_TICKET_USED, pack.uint64.serialise((expires,))[1] + ticket_id)
+        return secret
+
+    async def _resume_handshake(self, client: ProtoSocket, resume: HandshakeResume, secret: bytes, update_task: asyncio.Task) -> tuple[CryptSocket, bytes]|None:
+        # same flight as the fast handshake, with the key derived from the ticket's secret instead of a key exchange
+        await self._call_hook(client, "client_handshake")
+        mode = await self._select_mode(client, resume.crypt_modes, update_task)
+        if mode is None:
+            return None
+        server_random = get_random_bytes(32)
+        session_key = resumed_session_key(secret, self.KEY_LENGTH, resume.client_random, server_random)
+        await self._call_hook(client, "crypt_starting")
+
+        await client._write_packet(HandshakeResumeAccept(crypt_mode=mode.encode(), key_len=self.KEY_LENGTH, server_random=server_random))
+        client = CryptSocket(client)
+        client.set_encryption(self.ENCRYPTION_MODES[mode](session_key))
+        await client.wait_for_packet(HandshakeOK)
+        return client, session_key
+
+    async def _fast_handshake(self, client: ProtoSocket, initiate: HandshakeFastInitiate, update_task: asyncio.Task) -> tuple[CryptSocket, bytes]|None:
+        # the client sent its modes and key up front, so mode select, KEX and the go-ahead for encryption go back in one packet
+        await self._call_hook(client, "client_handshake")
+        mode = await self._select_mode(client, initiate.crypt_modes, update_task)
+        if mode is None:
+            return None
+        # the keypairs stay the same from one connection to the next, so both ends salt the key with fresh randomness
+        server_random = get_random_bytes(32)
+        session_key = await self._offload(self._key_agreement, initiate.public_key, initiate.client_random + server_random)
+        await self._call_hook(client, "crypt_kexok")
+        await self._call_hook(client, "crypt_starting")
+
+        await client._write_packet(HandshakeFastAccept(crypt_mode=mode.encode(), salt=server_random,
+                                                       key_len=self.KEY_LENGTH, public_key=self._public_key))
+        client = CryptSocket(client)
+        client.set_encryption(self.ENCRYPTION_MODES[mode](session_key))
+        # the client's first encrypted packet is the proof it derived the same key
+        await client.wait_for_packet(HandshakeOK)
+        return client, session_key
+
+    async def _legacy_handshake(self, client: ProtoSocket, update_task: asyncio.Task) -> tuple[CryptSocket, bytes]|None:
+        client.write_packet(HandshakeConfirm())
+        await self._call_hook(client, "client_handshake")
+
+        modeslist = (await client.wait_for_packet(HandshakeCryptModesList)).crypt_modes
+        mode = await self._select_mode(client, modeslist, update_task)
+        if mode is None:
+            return None
+        client.write_packet(HandshakeCryptModeSelect(crypt_mode=mode.encode()))
         # update_task.cancel()
         
-        client.write_packet(HandshakeCryptKEXServer(salt=self._session_nonce,
+        server_random = get_random_bytes(32) # see _fast_handshake
+        client.write_packet(HandshakeCryptKEXServer(salt=server_random,
                                                     key_len=self.KEY_LENGTH,
-                                                    public_key=self._keypair.public_key().export_key(format='PEM').encode()))
+                                                    public_key=self._public_key))
         kex_client = await client.wait_for_packet(HandshakeCryptKEXClient)
-        client_key = ECC.import_key(kex_client.public_key.decode())
+        session_key = await self._offload(self._key_agreement, kex_client.public_key, kex_client.client_random + server_random)
         await self._call_hook(client, "crypt_kexok")
 
-        crypter_cls = self.ENCRYPTION_MODES[shared_modes[0]]
+        crypter_cls = self.ENCRYPTION_MODES[mode]
 
-        session_key = DH.key_agreement(static_priv=self._keypair, static_pub=client_key, kdf=functools.partial(KDF.HKDF, key_len=self.KEY_LENGTH, salt=self._session_nonce, hashmod=SHA256, num_keys=1, context=b''))
         await self._call_hook(client, "crypt_starting")
 
         await client._write_packet(HandshakeCryptOK())
@@ -135,34 +447,52 @@ class Hyphen0Server:
             await self._call_hook(client, "crypt_testfail")
             update_task.cancel()
             client.close()
-            return
-        await self._call_hook(client, "crypt_complete")
-        self._connected_clients[client.getnicename()] = {'upd': update_task, 'sock': client}
-        await self._call_hook(client, "client_connected")
-        return await self.work(client)
+            return None
+        return client, session_key
 
     async def _serve_client_update(self, client: ProtoSocket):
-        while True:
-            try:
-                await client.update(0)
-            except SocketClosed:
-                print(f"[hyphen0] [{client.getnicename()}] connection terminated")
-                return await self.kick_client(client, graceful=False)
-            except Exception as e:
-                if not self._capture_errors: raise
-                print(f'[hyphen0] [{client.getnicename()}] {e}')
-                print(f"[hyphen0] [{client.getnicename()}] recv buffer", self._socket._recv_buffer)
-                for line in traceback.format_exc().split('\n'):
-                    print(f"[hyphen0] [{client.getnicename()}] {line}")
-                await self.kick_client(client, graceful=False)
-                raise
-            await asyncio.sleep(0)
+        try:
+            await client.pump()
+        except SocketClosed:
+            log.info("[%s] connection terminated", client.getnicename())
+            return await self.kick_client(client, graceful=False)
+        except QueueOverflow as e:
+            log.warning("[%s] %s, kicking", client.getnicename(), e)
+            return await self.kick_client(client, graceful=False)
+        except Exception as e:
+            if not self._capture_errors: raise
+            log.exception("[%s] %s (%d bytes left in the receive buffer)", client.getnicename(), e, len(client._recv_buffer))
+            await self.kick_client(client, graceful=False)
+            raise
 
     def get_client_data(self, client: ProtoSocket) -> dict:
         return self._connected_clients.get(client.getnicename())
     def get_clients(self) -> list[ProtoSocket]:
         return [dct['sock'] for dct in self._connected_clients.values()]
 
+    def broadcast(self, packet: Packet, filter = None) -> int:
+        """Queues the packet for every connected client (that `filter(client)` accepts, if given).
+        The packet is serialised once and shared, so each client only pays for its own encryption, done by its update task.
+        When serving with several workers, unfiltered broadcasts reach other workers' clients too, while a filter only ever
+        sees this worker's clients. Clients whose outbound queue is full under the "drain" policy (see set_queue_limits) are
+        skipped rather than queued past their limit, since nothing awaits their drain() here. Returns how many of this
+        worker's clients got the packet"""
+        serialised = packet.serialise(False)
+        if filter is None:
+            self._publish(WORKER_BROADCAST, serialised)
+        return self._broadcast_serialised(serialised, filter)
+    def _broadcast_serialised(self, serialised: bytes, filter = None) -> int:
+        count, skipped = 0, 0
+        for client in self.get_clients():
+            if filter is not None and not filter(client): continue
+            if client._writing_paused():
+                skipped += 1
+                continue
+            client.write_serialised(serialised)
+            count += 1
+        if skipped and self._metrics is not None: self._metrics.inc("broadcast_skipped", skipped)
+        return count
+
     async def kick_client(self, client: ProtoSocket, message: str = "Kicked by server", graceful: bool = True):
         await self._call_hook(client, "client_disconnecting")
         if graceful:
@@ -178,15 +508,17 @@ class Hyphen0Server:
         self._hooks[event][name] = callable
 
     async def _call_hook(self, client: ProtoSocket, event: str, *args, **kwargs):
-        if self._trace_hooks:
-            print(f"[hyphen0] [{'SERVER' if not client else client.getnicename()}] {event} {args} {kwargs}")
+        if self._trace_hooks and hook_log.isEnabledFor(logging.DEBUG):
+            hook_log.debug("[%s] %s %s %s", 'SERVER' if not client else client.getnicename(), event, args, kwargs)
+        return await self._run_hook(client, event, *args, **kwargs)
+    async def _run_hook(self, client: ProtoSocket, event: str, *args, **kwargs):
         for callable in self._hooks.get(event, {}).values():
             if inspect.iscoroutinefunction(callable):
                 await callable(client, *args, **kwargs)
             else:
                 callable(client, *args, **kwargs)
         if not hasattr(self, f"_event_{event}"):
-            return # print(f"[hyphen0] [{'SERVER' if not client else client.getnicename()}] no hook")
+            return
         callable = getattr(self, f"_event_{event}")
         if inspect.iscoroutinefunction(callable):
             return await callable(client, *args, **kwargs)
@@ -198,14 +530,26 @@ class Hyphen0Server:
     async def work(self, client: ProtoSocket):
         while True:
             if not client.getnicename() in self._connected_clients:
-                return print(f"[hyphen0] [{client.getnicename()}] client disappeared, bailing out")
+                return log.debug("[%s] client disappeared, bailing out", client.getnicename())
+            # next_packet() and sync hooks don't suspend while packets are queued, one busy client mustn't hog the loop
             await asyncio.sleep(0)
 
-            pack = client.read_packet()
-            if pack is None: continue
+            try:
+                pack = await client.next_packet()
+            except SocketClosed:
+                if client.getnicename() in self._connected_clients: raise
+                continue
             if isinstance(pack, Disconnect):
                 nicename = client.getnicename()
                 await self.kick_client(client, graceful=False)
                 raise WereDisconnected(nicename+": "+pack.message.decode())
-            await self._call_hook(client, "packet_received", pack)
-            await self._call_hook(client, f"ptype_{type(pack).__name__}_received", pack)
\ No newline at end of file
+            self._trace_packet(client, pack)
+            await self._run_hook(client, "packet_received", pack)
+            await self._run_hook(client, f"ptype_{type(pack).__name__}_received", pack)
+
+    def _trace_packet(self, client: ProtoSocket, packet: Packet):
+        # tracing every packet costs more than handling it on a busy server, so only a sample is
+        if not self.PACKET_TRACE_SAMPLE: return
+        self._packets_seen += 1
+        if self._packets_seen % self.PACKET_TRACE_SAMPLE == 0 and packet_log.isEnabledFor(logging.DEBUG):
+            packet_log.debug("[%s] received %r (1 in %d packets traced)", client.getnicename(), packet, self.PACKET_TRACE_SAMPLE)
\ No newline at end of file
@@ -0,0 +1,45 @@
+class RecvBuffer:
+    """Growable receive buffer with read and write cursors.
+    Received bytes are written straight into the free space after the write cursor and consumed by moving the read cursor,
+    the unread tail is only moved back to the front when there's no room left for the next read.
+    Nothing is allocated until the first reserve(), and once everything is consumed a buffer that grew past `size`
+    (for a large frame) gives the excess back, so listeners and idle connections don't sit on memory they don't use."""
+    def __init__(self, size: int = 65536):
+        self._size = size
+        self._buf = bytearray()
+        self._start = 0
+        self._end = 0
+
+    def __len__(self) -> int:
+        return self._end - self._start
+    def __repr__(self):
+        return f"<RecvBuffer {repr(bytes(self._buf[self._start:self._end]))}>"
+
+    def view(self) -> memoryview:
+        """Unread bytes. The view has to be released before the next reserve()."""
+        return memoryview(self._buf)[self._start:self._end]
+
+    def reserve(self, n: int) -> memoryview:
+        """Free space for at least n bytes after the write cursor. Release the view and commit() what was written into it."""
+        if len(self._buf) - self._end < n:
+            if self._start > 0:
+                self._buf[0:self._end - self._start] = self._buf[self._start:self._end]
+                self._end -= self._start
+                self._start = 0
+            if len(self._buf) - self._end < n:
+                self._buf.extend(bytes(max(n - (len(self._buf) - self._end), len(self._buf))))
+        return memoryview(self._buf)[self._end:self._end + n]
+
+    def commit(self, n: int):
+        self._end += n
+    def write(self, data: bytes):
+        with self.reserve(len(data)) as view:
+            view[0:len(data)] = data
+        self.commit(len(data))
+
+    def consume(self, n: int):
+        self._start += n
+        if self._start >= self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self._size:
+                del self._buf[self._size:]
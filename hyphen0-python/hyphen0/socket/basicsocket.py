@@ -1,15 +1,21 @@
 import socket
-import select
 import asyncio
 import time
+from collections import deque
+from itertools import islice
 
 from ..exceptions import SocketClosed
 
+IOV_MAX = 1024
+
 class BasicSocket:
     _socket: socket.socket
     _connected: bool
     _bound: bool
     _terminated: bool
+    _read_waiters: list
+    _write_waiters: list
+    _send_pending: deque
     def __init__(self):
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -18,6 +24,9 @@ class BasicSocket:
         self._bound = False
         self._terminated = False
         self._nicename = None
+        self._read_waiters = []
+        self._write_waiters = []
+        self._send_pending = deque()
     
     @classmethod
     def from_raw_socket(cls, sock: socket.socket):
@@ -33,6 +42,8 @@ class BasicSocket:
     
     def set_socket(self, sock: socket.socket):
         if self._connected or self._bound:
+            self._drop_waiters()
+            self._send_pending.clear()
             self._socket.close()
             self._connected = False
             self._bound = False
@@ -61,9 +72,12 @@ class BasicSocket:
         except Exception:
             raise
 
-    def bind(self, interface: str, port: int, max_clients: int = 8):
+    def bind(self, interface: str, port: int, max_clients: int = 8, reuse_port: bool = False):
+        # with reuse_port, several sockets (and processes) can listen on the same port, the kernel spreads connections among them
         try:
             self._socket.setblocking(True)
+            if reuse_port:
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._socket.bind((interface, port))
             self._socket.listen(max_clients)
             self._socket.setblocking(False)
@@ -76,6 +90,8 @@ class BasicSocket:
     def is_closed(self):
         return not self.is_open() and not self._terminated
     def _close(self):
+        self._drop_waiters()
+        self._send_pending.clear()
         self._socket.close()
         self._terminated = True
         self._connected = False
@@ -83,11 +99,58 @@ class BasicSocket:
     def close(self):
         return self._close()
 
+    def _io_ready(self, write: bool):
+        waiters = self._write_waiters if write else self._read_waiters
+        loop = asyncio.get_running_loop()
+        (loop.remove_writer if write else loop.remove_reader)(self._socket.fileno())
+        for fut in waiters:
+            if not fut.done(): fut.set_result(None)
+        waiters.clear()
+
+    def _drop_waiters(self):
+        # has to happen before the fd is closed, otherwise we might unregister someone else's fd later on
+        for write, waiters in ((False, self._read_waiters), (True, self._write_waiters)):
+            if not waiters: continue
+            loop = waiters[0].get_loop()
+            if self._socket.fileno() != -1 and not loop.is_closed():
+                (loop.remove_writer if write else loop.remove_reader)(self._socket.fileno())
+            for fut in waiters: # woken up waiters notice the closed fd themselves
+                if not fut.done(): fut.set_result(None)
+            waiters.clear()
+
+    async def _wait_ready(self, write: bool, timeout: float|None, wakeup: asyncio.Future|None = None):
+        # parks the caller until the socket is readable (or writeable). if a wakeup future is passed, it can
+        # cut the wait short, and running out of time just returns instead of raising
+        if self._socket.fileno() == -1:
+            raise SocketClosed()
+        if timeout is not None and timeout <= 0:
+            if wakeup is not None: return
+            raise TimeoutError("write timed out" if write else "receive timed out")
+        loop = asyncio.get_running_loop()
+        waiters = self._write_waiters if write else self._read_waiters
+        if not waiters:
+            (loop.add_writer if write else loop.add_reader)(self._socket.fileno(), self._io_ready, write)
+        fut = loop.create_future()
+        waiters.append(fut)
+        try:
+            if wakeup is not None:
+                await asyncio.wait((fut, wakeup), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                return
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("write timed out" if write else "receive timed out") from None
+        finally:
+            if fut in waiters:
+                waiters.remove(fut)
+                if not waiters and self._socket.fileno() != -1:
+                    (loop.remove_writer if write else loop.remove_reader)(self._socket.fileno())
+
     async def _accept(self):
         nsock, addr = self._socket.accept()
         sock = self.from_raw_socket(nsock)
         sock._bound = False
         sock._connected = True
+        sock._nicename = f"{addr[0]}:{addr[1]}" # still known after the peer hangs up
         return sock, addr
 
     async def accept(self):
@@ -96,15 +159,13 @@ class BasicSocket:
         if not self._bound:
             raise ValueError("attempted to accept from a connected socket")
         while True:
-            await asyncio.sleep(0)
-            try:
-                readable, _, _ = select.select([self._socket], [], [], 0)
-            except ValueError:
+            if self._socket.fileno() == -1:
                 raise SocketClosed()
-            if len(readable) == 0:
-                continue
-            sock, addr = await self._accept()
-            return sock, addr
+            try:
+                sock, addr = await self._accept()
+                return sock, addr
+            except (BlockingIOError, InterruptedError):
+                await self._wait_ready(False, None)
     
     async def _recv(self, n: int, timeout: float = 10, strict: bool = False) -> bytes:
         if not self.is_open():
@@ -113,58 +174,85 @@ class BasicSocket:
             raise ValueError("attempted to receive from a bound socket")
         
         data = b''
-        started = time.time()
+        deadline = time.monotonic() + timeout
         while (strict and len(data) < n) or len(data) == 0:
-            await asyncio.sleep(0)
-            try:
-                readable, _, _ = select.select([self._socket], [], [], 0)
-            except ValueError:
+            if self._socket.fileno() == -1:
                 raise SocketClosed()
-            if len(readable) == 0:
-                if time.time() - started > timeout:
-                    raise TimeoutError("receive timed out")
-                continue
-
             try:
                 recv = self._socket.recv(n - len(data))
-                if len(recv) == 0:
-                    self._close()
-                    raise ValueError("_socket.recv() returned 0 bytes (socket closed?)")
-                data += recv
+            except (BlockingIOError, InterruptedError):
+                await self._wait_ready(False, deadline - time.monotonic())
+                continue
             except OSError:
                 self._close()
-                raise 
-            except Exception as e:
-                print(f"ignoring exception {e}: add proper handling to remove this message!")
+                raise
+            if len(recv) == 0:
+                self._close()
+                raise SocketClosed("_socket.recv() returned 0 bytes")
+            data += recv
         return data
     
+    async def _recv_into(self, buf: memoryview, timeout: float = 10) -> int:
+        if not self.is_open():
+            raise ValueError("attempted to receive from a void socket")
+        if self._bound:
+            raise ValueError("attempted to receive from a bound socket")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._socket.fileno() == -1:
+                raise SocketClosed()
+            try:
+                n = self._socket.recv_into(buf)
+            except (BlockingIOError, InterruptedError):
+                await self._wait_ready(False, deadline - time.monotonic())
+                continue
+            except OSError:
+                self._close()
+                raise
+            if n == 0:
+                self._close()
+                raise SocketClosed("_socket.recv_into() returned 0 bytes")
+            return n
+    
     async def _send(self, data: bytes, timeout: float = 10):
+        await self._sendmsg([data], timeout)
+
+    def _send_backlog(self) -> bool:
+        return len(self._send_pending) > 0
+
+    async def _sendmsg(self, buffers: list[bytes], timeout: float = 10):
         if not self.is_open():
             raise ValueError("attempted to send to a void socket")
         if self._bound:
             raise ValueError("attempted to send to a bound socket")
-        
-        n = 0
-        started = time.time()
-        while n < len(data):
-            await asyncio.sleep(0)
-            try:
-                _, writeable, _ = select.select([], [self._socket], [], 0)
-            except ValueError:
-                raise SocketClosed()
-            if len(writeable) == 0:
-                if time.time() - started > timeout:
-                    raise TimeoutError("write timed out")
-                continue
 
+        # scatter/gather: partially sent buffers are advanced with memoryviews, never copied or joined.
+        # whatever doesn't make it out before the timeout stays queued and goes first next time, so a timeout
+        # can't tear a frame in half. sending nothing just pushes that backlog
+        views = self._send_pending
+        views.extend(memoryview(buf) for buf in buffers if len(buf) > 0)
+        deadline = time.monotonic() + timeout
+        while views:
+            if self._socket.fileno() == -1:
+                raise SocketClosed()
             try:
-                sent = self._socket.send(data[n:])
-                if sent == 0:
-                    self._close()
-                    raise ValueError("_socket.send() returned 0 (socket closed?)")
-                n += sent
+                if hasattr(self._socket, "sendmsg"):
+                    sent = self._socket.sendmsg(list(islice(views, IOV_MAX)))
+                else:
+                    sent = self._socket.send(views[0])
+            except (BlockingIOError, InterruptedError):
+                await self._wait_ready(True, deadline - time.monotonic())
+                continue
             except OSError:
                 self._close()
-                raise 
-            except Exception as e:
-                print(f"ignoring exception {e}: add proper handling to remove this message!")
\ No newline at end of file
+                raise
+            if sent == 0:
+                self._close()
+                raise SocketClosed("_socket.send() returned 0")
+            while sent > 0:
+                if sent >= len(views[0]):
+                    sent -= len(views.popleft())
+                    continue
+                views[0] = views[0][sent:]
+                sent = 0
\ No newline at end of file
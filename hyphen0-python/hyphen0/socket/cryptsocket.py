@@ -1,3 +1,5 @@
+import time
+
 from .protosocket import ProtoSocket
 
 from ..encryption._crypter import _Crypter
@@ -9,6 +11,7 @@ class CryptSocket(ProtoSocket):
 
     def __init__(self, _socket):
         self._encryption = None
+        self._decrypt_buffer = bytearray()
 
     def __new__(cls, sock: ProtoSocket):
         assert isinstance(sock, ProtoSocket)
@@ -22,28 +25,66 @@ class CryptSocket(ProtoSocket):
             return
         if not isinstance(crypter, _Crypter):
             raise ValueError("crypter has to be instance of _Crypter or None")
+        crypter.set_serverbound(self._serverbound)
         self._encryption = crypter
     
-    async def _read_packet(self, timeout: float = 10) -> Packet:
+    async def _decode_buffered(self) -> Packet|None:
         if self._encryption == None:
             raise ValueError("CryptSocket should have encryption set before reading packets")
-            # return await super()._read_packet(timeout)
+            # return super()._decode_buffered()
+        if len(self._recv_buffer) < 4:
+            return None
         try:
-            _, (size,) = pack.uint32.deserialise(await self._recv(4, timeout, True))
-            crypted = await self._recv(size, timeout, True)
+            with self._recv_buffer.view() as view:
+                _, (size,) = pack.uint32.deserialise_from(view, 0)
+                if len(view) < 4 + size:
+                    return None
+                # decrypted straight out of the receive buffer into a scratch buffer that's reused between packets. a frame
+                # decrypted off the event loop is copied out first, a read meanwhile may grow (and move) the receive buffer
+                if self._encryption.decrypts_in_place and len(self._decrypt_buffer) < size:
+                    self._decrypt_buffer = bytearray(size)
+                offloaded = bytes(view[4:4+size]) if self._executor is not None and size >= self._offload_threshold else None
+                if offloaded is None:
+                    with view[4:4+size] as crypted:
+                        packet = self._decrypt_packet(crypted)
+            self._recv_buffer.consume(4 + size)
+            if offloaded is not None:
+                packet = await self._offload(size, self._decrypt_packet, offloaded)
+        except Exception:
+            if self._metrics is not None: self._metrics.inc("decode_errors")
+            raise
+        return packet
+    def _decrypt_packet(self, crypted: memoryview) -> Packet:
+        started = time.perf_counter() if self._metrics is not None else 0
+        if not self._encryption.decrypts_in_place:
+            # decoded from what decrypt() returns, copying that into the scratch buffer first would only cost a copy
             decrypted = self._encryption.decrypt(crypted)
+            if self._metrics is not None: self._metrics.observe("decrypt_seconds", time.perf_counter() - started)
             _, packet = Packet.deserialise(decrypted, not self._serverbound)
             return packet
-        except TimeoutError:
-            pass
-    async def _write_packet(self, packet: Packet, timeout: float = 10):
+        with memoryview(self._decrypt_buffer) as decrypted:
+            decrypted_size = self._encryption.decrypt_into(crypted, decrypted)
+            if self._metrics is not None: self._metrics.observe("decrypt_seconds", time.perf_counter() - started)
+            _, packet = Packet.deserialise(decrypted[:decrypted_size], not self._serverbound)
+        return packet
+    def _frame_serialised(self, serialised: bytes) -> bytes:
         if self._encryption == None:
             raise ValueError("CryptSocket should have encryption set before write packets")
-            # return await super()._write_packet(packet, timeout)
+            # return super()._frame_serialised(serialised)
+        # size prefix and ciphertext are written into one buffer instead of being concatenated
+        frame = bytearray(4 + self._encryption.overhead + len(serialised))
+        with memoryview(frame) as view:
+            if self._metrics is None:
+                size = self._encryption.encrypt_into(serialised, view[4:])
+            else:
+                started = time.perf_counter()
+                size = self._encryption.encrypt_into(serialised, view[4:])
+                self._metrics.observe("encrypt_seconds", time.perf_counter() - started)
+            view[0:4] = pack.uint32.serialise((size,))[1]
+        del frame[4+size:]
+        return frame
+    async def _write_packet(self, packet: Packet, timeout: float = 10):
         try:
-            serialised = packet.serialise(self._serverbound)
-            crypted = self._encryption.encrypt(serialised)
-            _, size = pack.uint32.serialise((len(crypted),))
-            await self._send(size+crypted, timeout)
+            await super()._write_packet(packet, timeout)
         except TimeoutError:
             pass
\ No newline at end of file
@@ -1,71 +1,249 @@
 from .steganosocket import SteganoSocket, SteganoLayer
+from ._recvbuffer import RecvBuffer
 from ..packets.packet import Packet, pack, HeartbeatClientbound, HeartbeatServerbound
 
 from collections import deque
-from typing import Deque, Type, List
+from typing import Deque, Dict, Type, List
 
-from ..exceptions import IncompleteData, SocketFlatlined
+from ..exceptions import IncompleteData, SocketFlatlined, SocketClosed, QueueOverflow
+from ..metrics import Metrics
 
 import time
 import asyncio
 import random
 
+QUEUE_POLICIES = ("drain", "drop_oldest", "kick")
+
 class ProtoSocket(SteganoSocket):
-    def __init__(self, serverbound: bool = False, heartbeat_interval: int = 10, max_heartbeat_misses: int = 5, steganolayer: SteganoLayer|None = None):
+    _flush_window: float = 0.0
+    _high_watermark: int = 65536
+    _low_watermark: int = 16384
+    _inbound_limit: int|None = None
+    _outbound_limit: int|None = None
+    _queue_policy: str = "drain"
+    _metrics: Metrics|None = None
+
+    def __init__(self, serverbound: bool = False, heartbeat_interval: int = 10, max_heartbeat_misses: int = 5, steganolayer: SteganoLayer|None = None, read_size: int = 65536):
         super().__init__(steganolayer)
         if steganolayer: steganolayer.set_serverbound(serverbound)
         self._serverbound = serverbound
         self._inbound: Deque[Packet] = deque()
-        self._outbound: Deque[Packet] = deque()
-        self._recv_buffer: bytes = b''
+        self._outbound: Deque[Packet|bytes] = deque() # packets, or already serialised ones
+        self._recv_buffer: RecvBuffer = RecvBuffer(read_size)
+        self._read_size: int = read_size
         self._last_packet_received: int = time.time() - (heartbeat_interval / 2) if serverbound else time.time()
         self._heartbeat_interval: int = heartbeat_interval # if serverbound else heartbeat_interval * 1.5
         self._missed_heartbeats: int = 0
         self._max_heartbeat_misses: int = max_heartbeat_misses
         self._heartbeat_nonce: int = None
+        self._heartbeat_sent: float = 0
         self._heartbeat_incoming = HeartbeatClientbound if serverbound else HeartbeatServerbound
         self._heartbeat_outgoing = HeartbeatServerbound if serverbound else HeartbeatClientbound
+        self._inbound_waiters: List[asyncio.Future] = []
+        self._packet_waiters: Dict[Type[Packet], List[asyncio.Future]] = {}
+        self._pump_wakeup: asyncio.Future|None = None
+        self._unsent: Deque[bytes] = deque()
+        self._unsent_bytes: int = 0
+        self._unsent_since: float = 0
+        self._write_lock = asyncio.Lock()
+        self._frame_lock = asyncio.Lock()
+        self._drain_waiters: List[asyncio.Future] = []
+        self._overflowed: bool = False
+        self._queue_peaks: List[int] = [0, 0] # inbound, outbound
+        self._queue_dropped: List[int] = [0, 0]
+
+    def _close(self):
+        super()._close()
+        for fut in self._inbound_waiters:
+            if not fut.done(): fut.set_result(None)
+        self._inbound_waiters.clear()
+        for waiters in self._packet_waiters.values():
+            for fut in waiters:
+                if not fut.done(): fut.set_result(None)
+        self._packet_waiters.clear()
+        for fut in self._drain_waiters:
+            if not fut.done(): fut.set_result(None)
+        self._drain_waiters.clear()
+        self._wake_pump()
+
+    def _wake_pump(self):
+        if self._pump_wakeup and not self._pump_wakeup.done():
+            self._pump_wakeup.set_result(None)
+
+    async def _accept(self):
+        sock, addr = await super()._accept()
+        sock._read_size, sock._recv_buffer = self._read_size, RecvBuffer(self._read_size)
+        sock._flush_window = self._flush_window
+        sock._high_watermark, sock._low_watermark = self._high_watermark, self._low_watermark
+        sock._inbound_limit, sock._outbound_limit, sock._queue_policy = self._inbound_limit, self._outbound_limit, self._queue_policy
+        if self._metrics is not None: sock._metrics = Metrics() # every connection counts for itself
+        return sock, addr
+
+    def enable_metrics(self, enabled: bool = True):
+        """Starts (or stops) counting bytes, packets, decode errors and heartbeat round trips. Sockets accepted
+        from a listener with metrics enabled get their own. Costs next to nothing while disabled"""
+        self._metrics = Metrics() if enabled else None
+    def metrics(self) -> dict|None:
+        """Snapshot of the counters and histograms, with the queue depths as gauges. None if metrics aren't enabled"""
+        if self._metrics is None:
+            return None
+        stats = self.queue_stats()
+        snapshot = self._metrics.snapshot({name: value for name, value in stats.items() if not name.endswith("_dropped")})
+        snapshot["counters"]["inbound_dropped"] = stats["inbound_dropped"]
+        snapshot["counters"]["outbound_dropped"] = stats["outbound_dropped"]
+        return snapshot
+
+    def set_queue_limits(self, inbound: int|None = None, outbound: int|None = None, policy: str = "drain"):
+        """Bounds the packet queues. What happens when one is full depends on the policy:
+        "drain" stops reading from the socket until inbound packets are consumed, and leaves it to writers to await drain(),
+        "drop_oldest" throws away the oldest queued packet, "kick" makes pump() raise QueueOverflow."""
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"queue policy should be one of {QUEUE_POLICIES}, got {repr(policy)}")
+        self._inbound_limit, self._outbound_limit, self._queue_policy = inbound, outbound, policy
+    def queue_stats(self) -> dict:
+        return {
+            "inbound": len(self._inbound), "inbound_peak": self._queue_peaks[0], "inbound_dropped": self._queue_dropped[0],
+            "outbound": self._outbound_depth(), "outbound_peak": self._queue_peaks[1], "outbound_dropped": self._queue_dropped[1],
+            "unsent_bytes": self._unsent_bytes,
+        }
+    def _outbound_depth(self) -> int:
+        return len(self._outbound) + len(self._unsent)
+    def _reading_paused(self) -> bool:
+        return self._queue_policy == "drain" and self._inbound_limit is not None and len(self._inbound) >= self._inbound_limit
+    def _writing_paused(self) -> bool:
+        return self._queue_policy == "drain" and self._outbound_limit is not None and self._outbound_depth() >= self._outbound_limit
+
+    def set_flush_window(self, window: float):
+        """Nagle-style coalescing: hold back small writes for up to `window` seconds so more packets go out in the same send.
+        0 (the default) sends as soon as packets are queued."""
+        self._flush_window = window
+    def set_write_buffer_limits(self, high: int|None = None, low: int|None = None):
+        """`high` caps how many bytes of frames go into a single send, `low` is how many buffered bytes end the flush window early."""
+        self._high_watermark = 65536 if high is None else high
+        self._low_watermark = self._high_watermark // 4 if low is None else low
+        if not 0 <= self._low_watermark <= self._high_watermark:
+            raise ValueError(f"write buffer limits should satisfy 0 <= low <= high, got low={self._low_watermark} high={self._high_watermark}")
+
+    async def _fill_recv_buffer(self, timeout: float = 10):
+        with self._recv_buffer.reserve(self._read_size) as view:
+            received = await self._recv_into(view, timeout)
+        self._recv_buffer.commit(received)
+        if self._metrics is not None: self._metrics.inc("bytes_received", received)
+
+    async def _decode_buffered(self) -> Packet|None:
+        if len(self._recv_buffer) == 0:
+            return None
+        try:
+            with self._recv_buffer.view() as view:
+                consumed, packet = Packet.deserialise(view, not self._serverbound)
+        except IncompleteData:
+            return None
+        except Exception:
+            if self._metrics is not None: self._metrics.inc("decode_errors")
+            raise
+        self._recv_buffer.consume(consumed)
+        return packet
 
     async def _read_packet(self, timeout: float = 10) -> Packet:
+        # whatever is already buffered goes first, so one read can yield several packets
+        packet = await self._decode_buffered()
+        if packet is not None:
+            return packet
         try:
-            self._recv_buffer += await self._recv(1024, timeout)
+            await self._fill_recv_buffer(timeout)
         except TimeoutError:
             pass
-        try:
-            consumed, packet = Packet.deserialise(self._recv_buffer, not self._serverbound)
-            self._recv_buffer = self._recv_buffer[consumed:]
-            return packet
-        except IncompleteData:
-            pass
+        return await self._decode_buffered()
+    def _frame_serialised(self, serialised: bytes) -> bytes:
+        return serialised
+    async def _frame(self, packet: Packet|bytes) -> bytes:
+        serialised = packet if isinstance(packet, bytes) else packet.serialise(self._serverbound)
+        if self._metrics is not None: self._metrics.inc("packets_sent")
+        return await self._offload(len(serialised), self._frame_serialised, serialised)
+    async def _frame_outbound(self, packet: Packet|None = None):
+        # one framer at a time, so frames line up in the order packets were queued however long each takes to frame
+        async with self._frame_lock:
+            while self._outbound:
+                self._queue_frame(await self._frame(self._outbound.popleft()))
+            if packet is not None:
+                self._queue_frame(await self._frame(packet))
+    def _queue_frame(self, frame: bytes):
+        if not self._unsent: self._unsent_since = time.monotonic()
+        self._unsent.append(frame)
+        self._unsent_bytes += len(frame)
+    def _flush_due(self) -> bool:
+        return self._flush_window <= 0 or self._unsent_bytes >= self._low_watermark \
+            or time.monotonic() - self._unsent_since >= self._flush_window
+    async def _send_unsent(self, timeout: float = 10):
+        # frames go out in scatter/gather batches of up to high watermark bytes, in the order they were framed
+        async with self._write_lock:
+            # a backlog left over from a timed out send goes first, and if it still can't get out, our frames stay queued
+            if self._send_backlog(): await self._sendmsg([], timeout)
+            while self._unsent:
+                batch, size = [], 0
+                while self._unsent and (not batch or size + len(self._unsent[0]) <= self._high_watermark):
+                    batch.append(self._unsent.popleft())
+                    size += len(batch[-1])
+                self._unsent_bytes -= size
+                await self._sendmsg(batch, timeout)
+                if self._metrics is not None: self._metrics.inc("bytes_sent", size)
+                self._wake_drainers()
+    def _wake_drainers(self):
+        if not self._drain_waiters or self._outbound_depth() > (self._outbound_limit or 0) // 2:
+            return
+        for fut in self._drain_waiters:
+            if not fut.done(): fut.set_result(None)
+        self._drain_waiters.clear()
     async def _write_packet(self, packet: Packet, timeout: float = 10):
-        serialised = packet.serialise(self._serverbound)
-        await self._send(serialised, timeout)
-
-    async def update(self, timeout: float = 10):
-        read = await self._read_packet(timeout)
-        if isinstance(read, self._heartbeat_incoming):
-            if read.initiating:
-                # print(f"received initiating heartbeat, nonce={read.nonce}")
+        # sent right away, but still behind whatever was queued before it
+        await self._frame_outbound(packet)
+        await self._send_unsent(timeout)
+    async def _flush_outbound(self, timeout: float = 10) -> bool:
+        await self._frame_outbound()
+        if not self._send_backlog() and (not self._unsent or not self._flush_due()):
+            return False
+        try:
+            await self._send_unsent(timeout)
+        except TimeoutError:
+            return False # whatever didn't fit stays in the backlog, pump() waits for the socket to turn writeable
+        return True
+
+    async def _handle_packet(self, read: Packet) -> bool:
+        if self._metrics is not None: self._metrics.inc("packets_received")
+        if not isinstance(read, self._heartbeat_incoming):
+            self._dispatch_inbound(read)
+            self._last_packet_received = time.time()
+            return True
+        if read.initiating:
+            # print(f"received initiating heartbeat, nonce={read.nonce}")
+            self._missed_heartbeats = 0
+            self._heartbeat_nonce = None
+            # print(f"sending reply heartbeat, nonce={read.nonce}")
+            await self._write_packet(self._heartbeat_outgoing(nonce=read.nonce, initiating=False))
+            self._last_packet_received = time.time() + 1
+        else:
+            if read.nonce != self._heartbeat_nonce:
+                pass
+                # print("bad nonce on heartbeat packet. are we running behind or ahead?")
+            else:
+                # print(f"received reply heartbeat, nonce={read.nonce}")
+                if self._metrics is not None: self._metrics.observe("heartbeat_rtt_seconds", time.monotonic() - self._heartbeat_sent)
                 self._missed_heartbeats = 0
                 self._heartbeat_nonce = None
-                # print(f"sending reply heartbeat, nonce={read.nonce}")
-                await self._write_packet(self._heartbeat_outgoing(nonce=read.nonce, initiating=False))
-                self._last_packet_received = time.time() + 1
-            else:
-                if read.nonce != self._heartbeat_nonce:
-                    pass
-                    # print("bad nonce on heartbeat packet. are we running behind or ahead?")
-                else:
-                    # print(f"received reply heartbeat, nonce={read.nonce}")
-                    self._missed_heartbeats = 0
-                    self._heartbeat_nonce = None
-                self._last_packet_received = time.time()
-            read = None
-
-        if read is not None:
-            self._inbound.append(read)
             self._last_packet_received = time.time()
-        elif time.time() - self._last_packet_received > self._heartbeat_interval:
+        return False
+
+    async def update(self, timeout: float = 10) -> bool:
+        read = None if self._reading_paused() else await self._read_packet(timeout)
+        busy = read is not None
+        received = False
+        # drain every complete packet that's already buffered, not just the first one
+        while read is not None:
+            received = await self._handle_packet(read) or received
+            read = None if self._reading_paused() else await self._decode_buffered()
+
+        # a paused reader can't see heartbeat replies, and the peer has obviously been talking to us anyway
+        if not received and not self._reading_paused() and time.time() - self._last_packet_received > self._heartbeat_interval:
             if self._heartbeat_nonce:
                 # print(f"missed heartbeat! count={self._missed_heartbeats}")
                 self._missed_heartbeats += 1
@@ -73,34 +251,146 @@ class ProtoSocket(SteganoSocket):
                 raise SocketFlatlined(f"missed {self._missed_heartbeats} heartbeats")
             self._last_packet_received = time.time()
             self._heartbeat_nonce = random.randint(0, 2**32-1)
+            self._heartbeat_sent = time.monotonic()
             # print(f"sending initiating heartbeat, nonce={self._heartbeat_nonce}")
             await self._write_packet(self._heartbeat_outgoing(nonce=self._heartbeat_nonce, initiating=True))
         
-        if self.outbound_pending() > 0:
-            await self._write_packet(self._outbound.popleft(), timeout)
+        if self.outbound_pending() or self._unsent or self._send_backlog():
+            busy = await self._flush_outbound(timeout) or busy
+        return busy
+
+    async def pump(self):
+        """Services the socket until it is closed. Sleeps on the event loop while there's nothing to read,
+        nothing to send and no heartbeat due, instead of spinning on update(0)."""
+        while self.is_open():
+            if self._overflowed:
+                raise QueueOverflow(f"packet queue overflowed (inbound={len(self._inbound)}, outbound={self._outbound_depth()})")
+            if await self.update(0) or (self._recv_pending() and not self._reading_paused()):
+                # reads, sends and uncontended locks all return without suspending while a peer keeps us busy,
+                # so give the rest of the loop a turn before going on
+                await asyncio.sleep(0)
+                continue
+            self._pump_wakeup = wakeup = asyncio.get_running_loop().create_future()
+            try:
+                if self.outbound_pending() or self._overflowed: continue
+                # with the kernel's send buffer full, held back frames can't go out before the socket turns writeable,
+                # so their flush deadline isn't worth waking up for (it would spin us without ever yielding)
+                flush_due = self._unsent and not self._send_backlog()
+                if self._send_backlog():
+                    # the kernel's send buffer is full, the socket turning writeable is worth waking up for too
+                    wakeup = asyncio.ensure_future(self._wait_ready(True, None, self._pump_wakeup))
+                if self._reading_paused():
+                    # only consuming inbound packets (or sending) can make progress, readability would just spin us
+                    wait = self._flush_window - (time.monotonic() - self._unsent_since) if flush_due else None
+                    await asyncio.wait((wakeup,), timeout=wait)
+                    continue
+                wait = self._heartbeat_interval - (time.time() - self._last_packet_received)
+                if flush_due:
+                    wait = min(wait, self._flush_window - (time.monotonic() - self._unsent_since))
+                await self._wait_ready(False, wait, wakeup)
+            finally:
+                if wakeup is not self._pump_wakeup: wakeup.cancel()
+                self._pump_wakeup = None
+
+    def _dispatch_inbound(self, packet: Packet):
+        # hand the packet straight to whoever is waiting for its type, queue it otherwise
+        for ptype in type(packet).__mro__:
+            waiters = self._packet_waiters.get(ptype)
+            while waiters:
+                fut = waiters.pop(0)
+                if fut.done(): continue
+                fut.set_result(packet)
+                return
+        if self._inbound_limit is not None and len(self._inbound) >= self._inbound_limit:
+            # with "drain" reading pauses before we get here
+            self._queue_dropped[0] += 1
+            if self._queue_policy == "kick":
+                self._overflowed = True
+                return
+            self._inbound.popleft()
+        self._inbound.append(packet)
+        self._queue_peaks[0] = max(self._queue_peaks[0], len(self._inbound))
+        for fut in self._inbound_waiters:
+            if not fut.done(): fut.set_result(None)
+        self._inbound_waiters.clear()
 
     def inbound_pending(self):
         return len(self._inbound) > 0
     def outbound_pending(self):
         return len(self._outbound) > 0
 
+    def _pop_inbound(self, i: int = 0) -> Packet:
+        packet = self._inbound.popleft() if i == 0 else self._inbound[i]
+        if i != 0: del self._inbound[i]
+        if self._inbound_limit is not None: self._wake_pump() # might have been paused on a full queue
+        return packet
+
     def read_packet(self) -> Packet:
-        return None if not self.inbound_pending() else self._inbound.popleft()
+        return None if not self.inbound_pending() else self._pop_inbound()
     def write_packet(self, packet: Packet):
+        self._enqueue_outbound(packet)
+    def write_serialised(self, serialised: bytes):
+        """Queues a packet that was already serialised for this socket's direction, so one serialisation can be shared between sockets."""
+        self._enqueue_outbound(serialised)
+    def _enqueue_outbound(self, packet: Packet|bytes):
+        if self._outbound_limit is not None and self._outbound_depth() >= self._outbound_limit:
+            # with "drain" the writer is expected to await drain(), so the packet is still queued
+            if self._queue_policy == "kick":
+                self._queue_dropped[1] += 1
+                self._overflowed = True
+                self._wake_pump()
+                return
+            if self._queue_policy == "drop_oldest":
+                self._queue_dropped[1] += 1
+                if self._outbound: self._outbound.popleft()
+                elif self._unsent: self._unsent_bytes -= len(self._unsent.popleft())
         self._outbound.append(packet)
+        self._queue_peaks[1] = max(self._queue_peaks[1], self._outbound_depth())
+        self._wake_pump()
+    async def drain(self):
+        """Waits until the outbound queue has been sent down to half of its limit (or entirely, if it isn't limited)."""
+        while self._outbound_depth() > (self._outbound_limit or 0) // 2:
+            if not self.is_open():
+                raise SocketClosed()
+            fut = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(fut)
+            try:
+                await fut
+            finally:
+                if fut in self._drain_waiters: self._drain_waiters.remove(fut)
+    async def next_packet(self, timeout: float|None = None) -> Packet:
+        while not self.inbound_pending():
+            if not self.is_open():
+                raise SocketClosed()
+            fut = asyncio.get_running_loop().create_future()
+            self._inbound_waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("packet did not appear before timeout expiry") from None
+            finally:
+                if fut in self._inbound_waiters: self._inbound_waiters.remove(fut)
+        return self._pop_inbound()
     async def wait_for_packet(self, ptype: Type[Packet]|List[Type[Packet]], timeout: float = 10) -> Packet:
-        started = time.time()
-        while True:
-            await asyncio.sleep(0)
-            if time.time() - started > timeout:
-                raise TimeoutError("packet did not appear before timeout expiry")
-            for i in self._inbound:
-                if isinstance(ptype, list):
-                    for j in ptype:
-                        if not isinstance(i, j): continue
-                        self._inbound.remove(i)
-                        return i
-                    continue
-                if not isinstance(i, ptype): continue
-                self._inbound.remove(i)
-                return i
\ No newline at end of file
+        ptypes = tuple(ptype) if isinstance(ptype, list) else (ptype,)
+        for i, packet in enumerate(self._inbound):
+            if not isinstance(packet, ptypes): continue
+            return self._pop_inbound(i)
+        if not self.is_open():
+            raise SocketClosed()
+
+        fut = asyncio.get_running_loop().create_future()
+        for t in ptypes:
+            self._packet_waiters.setdefault(t, []).append(fut)
+        try:
+            packet = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("packet did not appear before timeout expiry") from None
+        finally:
+            for t in ptypes:
+                waiters = self._packet_waiters.get(t)
+                if waiters and fut in waiters: waiters.remove(fut)
+                if t in self._packet_waiters and not self._packet_waiters[t]: del self._packet_waiters[t]
+        if packet is None:
+            raise SocketClosed()
+        return packet
@@ -1,15 +1,31 @@
 import time
 import socket
+import asyncio
+from concurrent.futures import Executor
 
 from .basicsocket import BasicSocket
 from ..stegano._layer import SteganoLayer
 
 class SteganoSocket(BasicSocket):
     _steganolayer: SteganoLayer|None = None
+    _executor: Executor|None = None
+    _offload_threshold: int = 65536
     def __init__(self, steganolayer: SteganoLayer|None = None):
         super().__init__()
         self._steganolayer = steganolayer
+
+    def set_executor(self, executor: Executor|None, threshold: int = 65536):
+        """Payloads of at least `threshold` bytes get encrypted, decrypted and stegano-wrapped on `executor`
+        instead of the event loop thread, so one big payload doesn't stall every other connection. None turns it off."""
+        self._executor, self._offload_threshold = executor, threshold
+    async def _offload(self, size: int, func, *args):
+        if self._executor is None or size < self._offload_threshold:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
         
+    def _recv_pending(self) -> bool:
+        return self._steganolayer is not None and len(self._steganolayer.unwrapped_recv_buffer) > 0
+
     async def _recv(self, n: int, timeout: float = 10, strict: bool = False) -> bytes:
         if not self._steganolayer: return await super()._recv(n, timeout, strict)
 
@@ -17,29 +33,44 @@ class SteganoSocket(BasicSocket):
         started = time.time()
         while (strict and len(data) < n) or len(data) == 0:
             try:
-                self._steganolayer.push_recv(await super()._recv(self._steganolayer.chunk_size, timeout - (time.time() - started), False))
+                self._steganolayer.push_recv(await super()._recv(self._steganolayer.recv_size, timeout - (time.time() - started), False))
             except TimeoutError:
                 if self._steganolayer.can_pull_recv():
-                    data += self._steganolayer.pull_recv(n - len(data))
+                    data += await self._offload(len(self._steganolayer.recv_buffer), self._steganolayer.pull_recv, n - len(data))
                 if not strict:
                     return data
                 if len(data) == n:
                     return data
                 raise
-            data += self._steganolayer.pull_recv(n - len(data))
+            data += await self._offload(len(self._steganolayer.recv_buffer), self._steganolayer.pull_recv, n - len(data))
         return data
+
+    async def _recv_into(self, buf: memoryview, timeout: float = 10) -> int:
+        if not self._steganolayer: return await super()._recv_into(buf, timeout)
+
+        data = await self._recv(len(buf), timeout)
+        buf[0:len(data)] = data
+        return len(data)
         
     async def _send(self, data: bytes, timeout: float = 10):
         if not self._steganolayer: return await super()._send(data, timeout)
 
+        await super()._sendmsg(await self._offload(len(data), self._wrap_chunks, data), timeout)
+    def _wrap_chunks(self, data: bytes) -> list[bytes]:
         self._steganolayer.push_send(data)
+        chunks = []
         while self._steganolayer.can_pull_send():
-            await super()._send(self._steganolayer.pull_send(self._steganolayer.chunk_size), timeout)
+            chunks.append(self._steganolayer.pull_send(self._steganolayer.next_chunk_size()))
+        return chunks
     
+    async def _sendmsg(self, buffers: list[bytes], timeout: float = 10):
+        if not self._steganolayer: return await super()._sendmsg(buffers, timeout)
+        await self._send(b''.join(buffers), timeout)
+
     async def _accept(self):
         sock, addr = await super()._accept()
         if self._steganolayer:
-            sock._steganolayer = type(self._steganolayer)()
-            sock._steganolayer.set_serverbound(self._steganolayer.serverbound)
+            sock._steganolayer = self._steganolayer.copy()
+        sock._executor, sock._offload_threshold = self._executor, self._offload_threshold
         return sock, addr
         
\ No newline at end of file
@@ -1,2 +1,16 @@
-from .http import HTTPSteganoLayer
-from .tls import TLSSteganoLayer
\ No newline at end of file
+# layers are only imported once they're asked for, so using one doesn't pay for loading the others
+# (HTTPSteganoLayer drags in ua_generator)
+_LAYERS = {"HTTPSteganoLayer": ".http", "TLSSteganoLayer": ".tls"}
+
+def __getattr__(name: str):
+    if name not in _LAYERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    layer = getattr(importlib.import_module(_LAYERS[name], __name__), name)
+    globals()[name] = layer
+    return layer
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAYERS))
+
+__all__ = list(_LAYERS)
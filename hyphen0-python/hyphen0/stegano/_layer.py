@@ -1,43 +1,103 @@
+from ..exceptions import IncompleteData
+
+class _ByteQueue:
+    """Bytes appended at the back and taken from the front. Taken bytes are only dropped once they make up most of
+    the buffer, so taking from the front doesn't move what's left every time."""
+    def __init__(self):
+        self.buf = bytearray()
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self.buf) - self.start
+    def __repr__(self):
+        return f"<ByteQueue {repr(bytes(self.buf[self.start:]))}>"
+
+    def append(self, data: bytes):
+        self.buf += data
+    def skip(self, n: int):
+        self.start += n
+        if self.start >= len(self.buf):
+            self.buf.clear()
+            self.start = 0
+        elif self.start > len(self.buf) // 2:
+            del self.buf[:self.start]
+            self.start = 0
+    def take(self, n: int) -> bytes:
+        data = bytes(self.buf[self.start:self.start+n])
+        self.skip(len(data))
+        return data
+
+class _LayerQueue:
+    """A _ByteQueue of the layer's own, made on first use, so layers whose __init__ doesn't call ours still get one"""
+    def __set_name__(self, owner, name):
+        self.name = name
+    def __get__(self, layer, owner=None):
+        if layer is None:
+            return self
+        queue = layer.__dict__[self.name] = _ByteQueue()
+        return queue
+
 class SteganoLayer:
+    """Wraps outgoing data in frames that look like something else, and unwraps incoming ones.
+    Subclasses implement wrap() and either unwrap_from(), which unwraps in place, or unwrap(), which gets a copy of
+    everything received from the start of the frame on."""
     serverbound: bool = False
     chunk_size: int = 1024
-    recv_buffer: bytes = b''
-    send_buffer: bytes = b''
-    unwrapped_recv_buffer: bytes = b''
-    
+    # how much wrapped data to read off the socket at once
+    recv_size: int = 65536
+    recv_buffer = _LayerQueue()
+    send_buffer = _LayerQueue()
+    unwrapped_recv_buffer = _LayerQueue()
+
+    def copy(self) -> "SteganoLayer":
+        """A fresh layer with the same settings, for another connection"""
+        layer = type(self)()
+        layer.set_serverbound(self.serverbound)
+        return layer
+
     def set_serverbound(self, serverbound: bool): self.serverbound = serverbound
 
     def wrap(self, data: bytes) -> bytes:
         raise NotImplementedError
-    def unwrap(self, data: bytes) -> tuple[int, bytes]:
-        raise NotImplementedError
-    
+    def unwrap(self, data: bytes) -> tuple[int, bytes]: # consumed, unwrapped
+        if type(self).unwrap_from is SteganoLayer.unwrap_from:
+            raise NotImplementedError
+        return self.unwrap_from(data, 0)
+    def unwrap_from(self, buf, offset: int = 0) -> tuple[int, bytes]: # new offset, unwrapped
+        """Unwraps the frame starting at offset in buf, raising IncompleteData if it hasn't fully arrived yet"""
+        if type(self).unwrap is SteganoLayer.unwrap:
+            raise NotImplementedError
+        consumed, unwrapped = self.unwrap(bytes(buf[offset:]))
+        return offset+consumed, unwrapped
+
+    def next_chunk_size(self) -> int:
+        """How much unwrapped data the next frame pulled with pull_send() should carry"""
+        return self.chunk_size
+
     def can_pull_send(self) -> bool:
         return len(self.send_buffer) > 0
     def can_pull_recv(self) -> bool:
-        return len(self.unwrapped_recv_buffer + self.recv_buffer) > 0
+        return len(self.unwrapped_recv_buffer) > 0 or len(self.recv_buffer) > 0
     def push_recv(self, data: bytes):
-        self.recv_buffer += data
+        self.recv_buffer.append(data)
     def push_send(self, data: bytes):
-        self.send_buffer += data
+        self.send_buffer.append(data)
     def pull_recv(self, n: int) -> bytes:
         if not self.can_pull_recv():
             return b""
-        if len(self.recv_buffer) > 0:
-            pulled, recvd = self.unwrap(self.recv_buffer)
-        else:
-            pulled, recvd = 0, b''
-        recvd = self.unwrapped_recv_buffer + recvd
-        self.recv_buffer = self.recv_buffer[pulled:]
-        if len(recvd) > n:
-            self.unwrapped_recv_buffer = recvd[n:]
-            recvd = recvd[:n]
-        else:
-            self.unwrapped_recv_buffer = b''
-        return recvd
+        # unwrap every complete frame right where it sits in recv_buffer, a partial one stays there until the rest of it arrives
+        recv = self.recv_buffer
+        while len(recv) > 0:
+            try:
+                offset, unwrapped = self.unwrap_from(recv.buf, recv.start)
+            except IncompleteData:
+                break
+            if offset == recv.start: # layers that only implement unwrap() may signal an incomplete frame this way
+                break
+            recv.skip(offset - recv.start)
+            self.unwrapped_recv_buffer.append(unwrapped)
+        return self.unwrapped_recv_buffer.take(n)
     def pull_send(self, n: int) -> bytes:
         if not self.can_pull_send():
             return b""
-        tsend = self.send_buffer[:n]
-        self.send_buffer = self.send_buffer[n:]
-        return self.wrap(tsend)
\ No newline at end of file
+        return self.wrap(self.send_buffer.take(n))
\ No newline at end of file
@@ -2,37 +2,124 @@ import random
 import string
 
 import base64
-import ua_generator
 
 from ._layer import SteganoLayer
+from ..exceptions import IncompleteData
 
 class HTTPSteganoLayer(SteganoLayer):
+    """Disguises frames as HTTP/1.1 requests (serverbound) and responses. Bodies are base64 by default, `binary`
+    sends them as they are with an application/octet-stream content type, and `chunked` sends the header once
+    and streams every frame after it as a chunk of one never-ending message. The receiving end works out which
+    of those the peer uses from the headers it gets."""
     _useragent_str: str = None
     _url: str = None
-    def set_url(self, url: str = None): self._url = url
+
+    def __init__(self, chunk_size: int|None = None, binary: bool = False, chunked: bool = False):
+        super().__init__()
+        if chunk_size is not None: self.chunk_size = chunk_size
+        self.binary, self.chunked = binary, chunked
+        self._header = None # built once per connection, see _make_header()
+        self._send_streaming = False
+        self._recv_streaming, self._recv_binary = False, False
+        # progress on the frame being received, see _parse_header()
+        self._header_scanned = 0
+        self._parsed_header = None
+
+    def copy(self) -> "HTTPSteganoLayer":
+        layer = type(self)(self.chunk_size, self.binary, self.chunked)
+        layer.set_serverbound(self.serverbound)
+        layer.set_url(self._url)
+        return layer
+
+    def set_serverbound(self, serverbound: bool):
+        super().set_serverbound(serverbound)
+        self._header = None
+    def set_url(self, url: str = None):
+        self._url = url
+        self._header = None
     def _randomstr(self):
-        return ''.join(string.ascii_letters[random.randint(0, len(string.ascii_letters)-1)] for i in range(random.randint(16, 32)))
+        return ''.join(random.choices(string.ascii_letters, k=random.randint(16, 32)))
     def _useragent(self):
         if not self._useragent_str:
+            import ua_generator # slow to import, and only needed by clients disguised as browsers
             self._useragent_str = ua_generator.generate().text
         return self._useragent_str
-    
+
     def _make_header(self) -> bytes:
+        # everything up to the body framing stays the same for the whole connection, so it's only put together once
+        if self._header is not None:
+            return self._header
         if self.serverbound:
-            return b"POST /"+(self._randomstr() if self._url is None else self._url).encode()+b" HTTP/1.1\nConnection: keep-alive\nCache-Control: max-age=0\nUser-Agent: "+self._useragent().encode()+b"\nAccept: */*\n"
-        return b"HTTP/1.1 200 OK\nConnection: keep-alive\nCache-Control: max-age=0\n"
-    def _parse_header(self, data) -> tuple[int, int]:
+            header = b"POST /"+(self._randomstr() if self._url is None else self._url).encode()+b" HTTP/1.1\r\nConnection: keep-alive\r\nCache-Control: max-age=0\r\nUser-Agent: "+self._useragent().encode()+b"\r\nAccept: */*\r\n"
+        else:
+            header = b"HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nCache-Control: max-age=0\r\n"
+        if self.binary:
+            header += b"Content-Type: application/octet-stream\r\n"
+        self._header = header + (b"Transfer-Encoding: chunked\r\n\r\n" if self.chunked else b"Content-Length: ")
+        return self._header
+    def _parse_header(self, data, offset: int = 0) -> tuple[int, dict[bytes, bytes]]: # body offset, headers
+        # a header that's still arriving is scanned on from where the last attempt stopped, and a complete one is kept
+        # until its frame is done, so waiting for a large body doesn't rescan or reparse it. everything is kept relative
+        # to the start of the frame, which stays put until the frame is done
+        if self._parsed_header is not None:
+            body, headers = self._parsed_header
+            return offset+body, headers
+        end = data.find(b"\r\n\r\n", offset+max(self._header_scanned-3, 0))
+        if end == -1:
+            self._header_scanned = len(data)-offset
+            raise IncompleteData()
         if self.serverbound: # server -> client
-            assert(data[0:15] == b"HTTP/1.1 200 OK")
-            return data.index(b"\n\n")+2, int(data[data.index(b"Content-Length: ")+16:data.index(b"\n\n")].decode())
-        assert(data[0:6] == b"POST /")
-        end = data.index(b"\n\n")+2
-        length = int(data[data.index(b"Content-Length: ")+16:end].decode())
-        return end, length
+            assert(data[offset:offset+15] == b"HTTP/1.1 200 OK")
+        else:
+            assert(data[offset:offset+6] == b"POST /")
+        headers = {}
+        for line in bytes(data[data.index(b"\r\n", offset)+2:end]).split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+        self._header_scanned, self._parsed_header = 0, (end+4-offset, headers)
+        return end+4, headers
+
+    def _encode(self, data: bytes) -> bytes:
+        return data if self.binary else base64.b64encode(data)
+    def _decode(self, encoded) -> bytes:
+        return bytes(encoded) if self._recv_binary else base64.b64decode(encoded)
 
     def wrap(self, data: bytes) -> bytes:
-        data = base64.b64encode(data)
-        return self._make_header()+b"Content-Length: "+str(len(data)).encode()+b"\n\n"+data
-    def unwrap(self, data: bytes) -> tuple[int, bytes]:
-        skip_header, data_size = self._parse_header(data)
-        return skip_header+data_size, base64.b64decode(data[skip_header:skip_header+data_size])
\ No newline at end of file
+        data = self._encode(data)
+        if not self.chunked:
+            return self._make_header()+str(len(data)).encode()+b"\r\n\r\n"+data
+        chunk = b"%x\r\n" % len(data) + data + b"\r\n"
+        if self._send_streaming:
+            return chunk
+        self._send_streaming = True
+        return self._make_header()+chunk
+    def unwrap_from(self, buf, offset: int = 0) -> tuple[int, bytes]: # new offset, unwrapped
+        if self._recv_streaming:
+            return self._unwrap_chunk(buf, offset)
+        body, headers = self._parse_header(buf, offset)
+        binary = headers.get(b"content-type") == b"application/octet-stream"
+        if headers.get(b"transfer-encoding") == b"chunked":
+            # from here on the peer only sends chunks, the header itself carries nothing
+            self._recv_streaming, self._recv_binary = True, binary
+            self._parsed_header = None
+            return body, b""
+        data_size = int(headers[b"content-length"])
+        if len(buf) < body+data_size:
+            raise IncompleteData()
+        self._recv_binary = binary
+        self._parsed_header = None
+        with memoryview(buf)[body:body+data_size] as encoded:
+            return body+data_size, self._decode(encoded)
+    def _unwrap_chunk(self, buf, offset: int) -> tuple[int, bytes]:
+        line = buf.find(b"\r\n", offset)
+        if line == -1:
+            raise IncompleteData()
+        data_size = int(bytes(buf[offset:line]).split(b";")[0], 16)
+        body = line+2
+        if len(buf) < body+data_size+2:
+            raise IncompleteData()
+        if data_size == 0: # last chunk, the next message starts with a header again
+            self._recv_streaming = False
+            return body+2, b""
+        with memoryview(buf)[body:body+data_size] as encoded:
+            return body+data_size+2, self._decode(encoded)
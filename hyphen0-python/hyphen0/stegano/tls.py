@@ -1,9 +1,39 @@
+import time
+
 from ._layer import SteganoLayer
+from ..exceptions import IncompleteData
 
 class TLSSteganoLayer(SteganoLayer):
+    # records start out fitting a single TCP segment, so the start of a burst can be unwrapped as soon as it arrives,
+    # and grow to the 16KiB TLS limit once the burst turns out to be bulk, the way TLS stacks size theirs.
+    # going idle for a while starts over with small records
+    small_record_size: int = 1400 - 5
+    max_record_size: int = 16384
+    bulk_after: int = 65536
+    idle_reset: float = 1.0
+
+    def __init__(self):
+        super().__init__()
+        self._burst = 0
+        self._last_record = 0.0
+
+    def next_chunk_size(self) -> int:
+        now = time.monotonic()
+        if now - self._last_record > self.idle_reset:
+            self._burst = 0
+        self._last_record = now
+        size = self.small_record_size if self._burst < self.bulk_after else self.max_record_size
+        self._burst += size
+        return size
+
     def wrap(self, data: bytes) -> bytes:
         return b"\x17\x03\x03" + len(data).to_bytes(2, 'big', signed=False) + data
-    def unwrap(self, data: bytes) -> tuple[int, bytes]:
-        assert data[0:3] == b"\x17\x03\x03"
-        data_len = int.from_bytes(data[3:5], 'big', signed=False)
-        return 5+data_len, data[5:5+data_len]
\ No newline at end of file
+    def unwrap_from(self, buf, offset: int = 0) -> tuple[int, bytes]: # new offset, unwrapped
+        if len(buf) - offset < 5:
+            raise IncompleteData()
+        assert buf[offset:offset+3] == b"\x17\x03\x03"
+        data_len = int.from_bytes(buf[offset+3:offset+5], 'big', signed=False)
+        end = offset+5+data_len
+        if len(buf) < end:
+            raise IncompleteData()
+        return end, bytes(buf[offset+5:end])
\ No newline at end of file
@@ -0,0 +1,41 @@
+import sys
+import subprocess
+
+# what importing hyphen0 and its dependencies may cost, in microseconds. the standard library doesn't count,
+# the interpreter pays for asyncio and friends either way
+IMPORT_BUDGET = 25000
+# only loaded once they're actually used
+LAZY_MODULES = ("ua_generator", "Crypto.Cipher.AES", "Crypto.Cipher.ChaCha20_Poly1305", "Crypto.PublicKey.ECC",
+                "Crypto.Protocol.DH", "Crypto.Protocol.KDF", "Crypto.Hash.SHA256", "hyphen0.stegano.http")
+
+def _importtime(statement: str) -> dict[str, int]:
+    # module -> microseconds spent importing it, not counting what it imported, as reported by python -X importtime
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = int(self_us)
+    return modules
+
+def _own_cost(modules: dict[str, int]) -> int:
+    return sum(us for name, us in modules.items() if name.split(".")[0] in ("hyphen0", "Crypto", "ua_generator", "cffi"))
+
+def _loaded(statement: str, modules: tuple[str, ...]) -> list[str]:
+    # which of modules are loaded once statement ran in a fresh interpreter
+    check = f"{statement}; import sys; print(' '.join(name for name in {modules!r} if name in sys.modules))"
+    return subprocess.run([sys.executable, "-c", check], capture_output=True, text=True, check=True).stdout.split()
+
+def test_import_lazy():
+    loaded = _loaded("import hyphen0.server, hyphen0.client, hyphen0.stegano", LAZY_MODULES)
+    assert not loaded, f"importing hyphen0 loaded {loaded}"
+
+    # using a layer only loads that one
+    assert _loaded("from hyphen0.stegano import TLSSteganoLayer", ("hyphen0.stegano.tls", "hyphen0.stegano.http")) == ["hyphen0.stegano.tls"]
+
+def test_import_budget():
+    # best of a few runs, a busy machine only ever makes it slower
+    cost = min(_own_cost(_importtime("import hyphen0.server, hyphen0.client, hyphen0.stegano")) for _ in range(3))
+    print(f"importing hyphen0 took {cost/1000:.1f}ms")
+    assert cost < IMPORT_BUDGET, f"importing hyphen0 took {cost/1000:.1f}ms, budget is {IMPORT_BUDGET/1000:.1f}ms"
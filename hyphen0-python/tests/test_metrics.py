@@ -0,0 +1,30 @@
+from hyphen0.metrics import Metrics, prometheus_text
+
+def test_metrics_prometheus():
+    metrics = Metrics()
+    metrics.inc("packets_received", 3)
+    metrics.observe("handshake_seconds", 0.003)
+    metrics.observe("handshake_seconds", 20)
+    other = Metrics()
+    other.inc("packets_received")
+    other.observe("handshake_seconds", 0.0001)
+    metrics.merge(other)
+
+    snapshot = metrics.snapshot({"connections": 2})
+    assert snapshot["counters"] == {"packets_received": 4}
+    histogram = snapshot["histograms"]["handshake_seconds"]
+    assert histogram["count"] == 3 and histogram["sum"] == 20.0031
+    # cumulative, with everything past the last bucket only in +Inf
+    assert dict(histogram["buckets"])[0.0001] == 1 and dict(histogram["buckets"])[0.005] == 2
+    assert histogram["buckets"][-2] == (10.0, 2) and histogram["buckets"][-1] == (float("inf"), 3)
+
+    text = prometheus_text([({"peer": "a"}, snapshot), ({"peer": 'b"'}, snapshot)])
+    lines = text.splitlines()
+    # one TYPE line per family, samples of every label set grouped under it
+    assert lines.count("# TYPE hyphen0_packets_received_total counter") == 1
+    assert lines[lines.index("# TYPE hyphen0_packets_received_total counter")+1:][:2] == \
+        ['hyphen0_packets_received_total{peer="a"} 4', 'hyphen0_packets_received_total{peer="b\\""} 4']
+    assert 'hyphen0_connections{peer="a"} 2' in lines
+    assert 'hyphen0_handshake_seconds_bucket{peer="a",le="+Inf"} 3' in lines
+    assert 'hyphen0_handshake_seconds_count{peer="a"} 3' in lines
+    assert prometheus_text([]) == ""
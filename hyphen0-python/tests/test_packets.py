@@ -0,0 +1,147 @@
+import time
+from array import array
+
+from hyphen0.packets import Packet, pack
+from hyphen0.exceptions import IncompleteData
+
+BENCH_ROUNDS = 20000
+
+class PacketTestTelemetry(Packet):
+    _serverbound: bool = True
+
+    sequence: pack.uint32 # type: ignore
+    flags: pack.uint8 # type: ignore
+    alive: pack.boolean # type: ignore
+    timestamp: pack.uint64 # type: ignore
+    name: pack.cstring # type: ignore
+    x: pack.int16 # type: ignore
+    y: pack.int16 # type: ignore
+    blob: pack.fixed(8) # type: ignore
+
+TEST_TELEMETRY = dict(sequence=123456, flags=7, alive=True, timestamp=2**40+5, name=b"sensor", x=-12, y=34, blob=b"abcdefgh")
+
+def _serialise_per_field(packet: Packet) -> bytes:
+    # how packets were encoded before codecs got compiled, kept around as a reference
+    raw = b''
+    for fname, ftype in packet._fields:
+        _, ser = ftype.serialise((getattr(packet, fname),))
+        raw += ser
+    return raw
+
+def _deserialise_per_field(raw: bytes, serverbound: bool) -> Packet:
+    _, (pid,) = pack.uint8.deserialise(raw)
+    packet_cls = Packet.find_by_pid(pid, serverbound)
+    fields = {}
+    for fname, ftype in packet_cls._fields:
+        consumed, (decoded,) = ftype.deserialise(raw)
+        raw = raw[consumed:]
+        fields[fname] = decoded
+    return packet_cls(**fields)
+
+def _rate(func, *args) -> float:
+    started = time.perf_counter()
+    for _ in range(BENCH_ROUNDS):
+        func(*args)
+    return BENCH_ROUNDS / (time.perf_counter() - started)
+
+def test_packet_codec_wire_format():
+    packet = PacketTestTelemetry(**TEST_TELEMETRY)
+    raw = packet.serialise(True)
+    assert raw == _serialise_per_field(packet)
+
+    consumed, decoded = Packet.deserialise(raw + b"trailing", True)
+    assert consumed == len(raw)
+    assert isinstance(decoded, PacketTestTelemetry)
+    for k, v in TEST_TELEMETRY.items():
+        assert getattr(decoded, k) == v
+
+    for i in range(len(raw)):
+        try:
+            Packet.deserialise(raw[:i], True)
+            assert False, f"decoded a packet truncated to {i} bytes"
+        except IncompleteData:
+            pass
+
+class PointStruct(pack.cstruct):
+    x: pack.int32 # type: ignore
+    labels: pack.array(pack.cstring) # type: ignore
+
+def test_primitives_deserialise_from():
+    raw = b"junk" + PointStruct.serialise((PointStruct(x=-5, labels=[b"a", b"bc", b""]),))[1] + b"junk"
+    for buf in (raw, bytearray(raw), memoryview(raw)):
+        offset, (decoded,) = PointStruct.deserialise_from(buf, 4)
+        assert offset == len(raw) - 4
+        assert decoded.x == -5
+        assert decoded.labels == [b"a", b"bc", b""]
+        assert all(type(label) == bytes for label in decoded.labels)
+
+    assert pack.cstring.deserialise(b"hello\0world\0") == (6, (b"hello",))
+    assert pack.fixed(3).deserialise_from(memoryview(b"abcdef"), 2) == (5, (b"cde",))
+    assert pack.bytestring.deserialise_from(memoryview(b"x" + pack.bytestring.serialise((b"a\0b",))[1]), 1) == (6, (b"a\0b",))
+    try:
+        pack.bytestring.deserialise(pack.bytestring.serialise((b"abc",))[1][:-1])
+        assert False, "decoded a truncated bytestring"
+    except IncompleteData:
+        pass
+    try:
+        pack.cstring.deserialise_from(memoryview(b"x" * 1000), 10)
+        assert False, "decoded a string without terminator"
+    except IncompleteData:
+        pass
+
+def test_array_deserialise_linear():
+    strings = pack.array(pack.cstring)
+    _, raw = strings.serialise(([b"item%d" % i for i in range(60000)],))
+    started = time.perf_counter()
+    consumed, (decoded,) = strings.deserialise(raw)
+    elapsed = time.perf_counter() - started
+    assert consumed == len(raw)
+    assert decoded[-1] == b"item59999"
+    # re-slicing the buffer per element takes tens of seconds here
+    assert elapsed < 2, f"decoding 60k elements took {elapsed:.2f}s"
+
+def test_array_numeric_fast_path():
+    values = [0, 1, 2**32-1, 123456789] * 1000
+    numbers = pack.array(pack.uint32)
+    _, raw = numbers.serialise((values,))
+    # same bytes as packing the elements one by one
+    assert raw == pack.uint16.serialise((len(values),))[1] + b''.join(pack.uint32.serialise((v,))[1] for v in values)
+    assert numbers.deserialise(raw) == (len(raw), (values,))
+    try:
+        numbers.deserialise(raw[:-1])
+        assert False, "decoded a truncated array"
+    except IncompleteData:
+        pass
+
+    buffered = pack.array(pack.int16, buffer=True)
+    _, raw = buffered.serialise((array('h', [-1, 2, -3]),))
+    assert raw == pack.array(pack.int16).serialise(([-1, 2, -3],))[1]
+    consumed, (decoded,) = buffered.deserialise(raw)
+    assert consumed == len(raw)
+    assert decoded == array('h', [-1, 2, -3])
+
+def test_array_numeric_benchmark():
+    values = list(range(60000))
+    numbers = pack.array(pack.uint32)
+    _, raw = numbers.serialise((values,))
+    def per_element_serialise():
+        return b''.join(pack.uint32.serialise((v,))[1] for v in values)
+    def per_element_deserialise():
+        offset, lst = 2, []
+        for _ in range(len(values)):
+            offset, (v,) = pack.uint32.deserialise_from(raw, offset)
+            lst.append(v)
+    def timed(func, *args):
+        started = time.perf_counter()
+        func(*args)
+        return (time.perf_counter() - started) / len(values) * 1e9
+    print()
+    print(f"array(uint32) serialise:   {timed(per_element_serialise):6.1f} -> {timed(numbers.serialise, (values,)):6.1f} ns/element")
+    print(f"array(uint32) deserialise: {timed(per_element_deserialise):6.1f} -> {timed(numbers.deserialise, raw):6.1f} ns/element")
+
+def test_packet_codec_benchmark():
+    packet = PacketTestTelemetry(**TEST_TELEMETRY)
+    raw = packet.serialise(True)
+    print()
+    print(f"serialise:   {_rate(_serialise_per_field, packet):10.0f} -> {_rate(packet.serialise, True):10.0f} packets/sec")
+    print(f"deserialise: {_rate(_deserialise_per_field, raw, True):10.0f} -> {_rate(Packet.deserialise, raw, True):10.0f} packets/sec")
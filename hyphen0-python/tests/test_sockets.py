@@ -1,10 +1,15 @@
 import asyncio
 import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from hyphen0.socket import ProtoSocket, CryptSocket
 from hyphen0.packets import Packet, pack
-from hyphen0.stegano import HTTPSteganoLayer
+from hyphen0.stegano import HTTPSteganoLayer, TLSSteganoLayer
 from hyphen0.encryption.aes import AESCrypter
+from hyphen0.exceptions import SocketClosed, QueueOverflow
 
 from Crypto.PublicKey import ECC
 
@@ -152,7 +157,470 @@ async def main_cryptsocket_stegano():
     server_peer_socket.close()
     server_host_socket.close()
 
+class PacketOtherClientbound(Packet):
+    _serverbound: bool = False
+
+    number: pack.uint32 # type: ignore
+
+async def main_wait_for_packet():
+    server_host_socket = ProtoSocket(False, 1, 5)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    server_update_task = asyncio.create_task(server_peer_socket.pump())
+    client_update_task = asyncio.create_task(client_host_socket.pump())
+
+    waiter = asyncio.create_task(client_host_socket.wait_for_packet(PacketOtherClientbound, 1))
+    await asyncio.sleep(0)
+    server_peer_socket.write_packet(PacketTestClientbound(string=TEST_STRING))
+    server_peer_socket.write_packet(PacketOtherClientbound(number=1337))
+
+    received = await waiter
+    assert isinstance(received, PacketOtherClientbound)
+    assert received.number == 1337
+    # nobody was waiting for that one, so it has to be queued instead
+    received = await client_host_socket.next_packet(1)
+    assert isinstance(received, PacketTestClientbound)
+    assert received.string == TEST_STRING
+
+    try:
+        await client_host_socket.wait_for_packet([PacketTestClientbound, PacketOtherClientbound], 0.1)
+        assert False, "got a packet that was never sent"
+    except TimeoutError:
+        pass
+    assert client_host_socket._packet_waiters == {}
+
+    server_update_task.cancel()
+    client_update_task.cancel()
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
+class PacketBulkServerbound(Packet):
+    _serverbound: bool = True
+
+    data: pack.fixed(100000) # type: ignore
+
+async def main_recv_buffer():
+    server_crypter, client_crypter = AESCrypter(TEST_KEY), AESCrypter(TEST_KEY)
+    server_host_socket = ProtoSocket(False, 1, 5, read_size=4096)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+    assert server_peer_socket._read_size == 4096
+    # nothing is allocated before the first read, and listeners never read
+    assert len(server_host_socket._recv_buffer._buf) == 0 and len(server_peer_socket._recv_buffer._buf) == 0
+
+    # lots of small packets arriving in one read
+    for i in range(200):
+        await client_host_socket._write_packet(PacketTestServerbound(string=str(i).encode()))
+    received = []
+    while len(received) < 200:
+        await server_peer_socket.update(1)
+        while server_peer_socket.inbound_pending():
+            received.append(server_peer_socket.read_packet())
+    assert [packet.string for packet in received] == [str(i).encode() for i in range(200)]
+
+    # a packet much larger than a single read, trickling in
+    server_peer_socket = CryptSocket(server_peer_socket)
+    client_host_socket = CryptSocket(client_host_socket)
+    server_peer_socket.set_encryption(server_crypter)
+    client_host_socket.set_encryption(client_crypter)
+    bulk = random.randbytes(100000)
+    sender = asyncio.create_task(client_host_socket._write_packet(PacketBulkServerbound(data=bulk)))
+    received = None
+    while received is None:
+        await server_peer_socket.update(1)
+        received = server_peer_socket.read_packet()
+    await sender
+    assert isinstance(received, PacketBulkServerbound)
+    assert received.data == bulk
+    # the buffer grew for the large packet, and gave it back once it was consumed
+    assert len(server_peer_socket._recv_buffer) == 0 and len(server_peer_socket._recv_buffer._buf) <= 4096
+
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
+async def main_burst():
+    server_host_socket = ProtoSocket(False, 1, 5)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    started = time.perf_counter()
+    for i in range(500):
+        server_peer_socket.write_packet(PacketTestClientbound(string=b"message %d" % i))
+    await server_peer_socket.update(0) # whole queue goes out at once
+    assert not server_peer_socket.outbound_pending()
+
+    received, updates = 0, 0
+    while received < 500:
+        await client_host_socket.update(1)
+        updates += 1
+        while client_host_socket.inbound_pending():
+            assert client_host_socket.read_packet().string == b"message %d" % received
+            received += 1
+    elapsed = time.perf_counter() - started
+    assert updates < 10, f"took {updates} updates to receive a burst"
+    print(f"\nburst of 500 small packets: {500 / elapsed:.0f} msgs/sec, {updates} receive updates")
+
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
+async def main_write_coalescing():
+    server_host_socket = ProtoSocket(False, 1, 5)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    sends = 0
+    sendmsg = server_peer_socket._sendmsg
+    async def counting_sendmsg(buffers, timeout = 10):
+        nonlocal sends
+        sends += 1
+        return await sendmsg(buffers, timeout)
+    server_peer_socket._sendmsg = counting_sendmsg
+
+    server_update_task = asyncio.create_task(server_peer_socket.pump())
+    client_update_task = asyncio.create_task(client_host_socket.pump())
+
+    # small packets written one by one within the flush window go out together
+    server_peer_socket.set_flush_window(0.05)
+    for i in range(50):
+        server_peer_socket.write_packet(PacketTestClientbound(string=b"small %d" % i))
+        await asyncio.sleep(0)
+    for i in range(50):
+        assert (await client_host_socket.next_packet(1)).string == b"small %d" % i
+    assert sends == 1, f"50 small packets took {sends} sends"
+
+    # a few megabytes at once: batched by the high watermark, partial writes all over the place
+    server_peer_socket.set_flush_window(0)
+    server_peer_socket.set_write_buffer_limits(high=16384)
+    sends = 0
+    for i in range(2000):
+        server_peer_socket.write_packet(PacketTestClientbound(string=(b"%d " % i) * 200))
+    for i in range(2000):
+        assert (await client_host_socket.next_packet(5)).string == (b"%d " % i) * 200
+    assert sends < 2000
+
+    server_update_task.cancel()
+    client_update_task.cancel()
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
+async def main_queue_limits():
+    server_host_socket = ProtoSocket(False, 1, 5)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    # drop_oldest keeps the newest packets
+    server_peer_socket.set_queue_limits(outbound=10, policy="drop_oldest")
+    for i in range(25):
+        server_peer_socket.write_packet(PacketTestClientbound(string=b"%d" % i))
+    stats = server_peer_socket.queue_stats()
+    assert stats["outbound"] == 10 and stats["outbound_dropped"] == 15
+    await server_peer_socket.update(0)
+    assert server_peer_socket.queue_stats()["outbound"] == 0
+
+    # drain stops reading once the inbound queue is full, the rest waits in the kernel
+    client_host_socket.set_queue_limits(inbound=4, policy="drain")
+    client_update_task = asyncio.create_task(client_host_socket.pump())
+    await asyncio.sleep(0.05)
+    assert client_host_socket.queue_stats()["inbound"] == 4
+    assert client_host_socket.queue_stats()["inbound_dropped"] == 0
+    for i in range(15, 25):
+        assert (await client_host_socket.next_packet(1)).string == b"%d" % i
+
+    # writers can wait for the queue to go out
+    server_peer_socket.set_queue_limits(outbound=10, policy="drain")
+    server_update_task = asyncio.create_task(server_peer_socket.pump())
+    for i in range(30):
+        server_peer_socket.write_packet(PacketTestClientbound(string=b"%d" % i))
+    await asyncio.wait_for(server_peer_socket.drain(), 1)
+    assert server_peer_socket.queue_stats()["outbound"] <= 5
+    for i in range(30):
+        assert (await client_host_socket.next_packet(1)).string == b"%d" % i
+
+    # kick makes the pump give up on the socket
+    client_host_socket.set_queue_limits(inbound=2, policy="kick")
+    for i in range(5):
+        server_peer_socket.write_packet(PacketTestClientbound(string=b"%d" % i))
+    try:
+        await asyncio.wait_for(client_update_task, 1)
+        assert False, "overflowing queue did not stop the pump"
+    except QueueOverflow:
+        pass
+
+    server_update_task.cancel()
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
+async def main_idle():
+    server_host_socket = ProtoSocket(False, 1, 5)
+    client_host_socket = ProtoSocket(True,  1, 5)
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    # an idle socket should be parked on the event loop, not spinning on it
+    cpu_started = time.process_time()
+    try:
+        await server_peer_socket._recv(1, 0.5)
+        assert False, "received data on an idle socket"
+    except TimeoutError:
+        pass
+    assert time.process_time() - cpu_started < 0.25, "idle receive burned cpu"
+
+    waiter = asyncio.create_task(server_peer_socket._recv(1, 10))
+    await asyncio.sleep(0)
+    server_peer_socket.close()
+    try:
+        await waiter
+        assert False, "closing socket did not wake up the receiver"
+    except SocketClosed:
+        pass
+
+    client_host_socket.close()
+    server_host_socket.close()
+
+async def main_flood_fairness():
+    server_host_socket = ProtoSocket(False, 10, 5)
+    server_host_socket.bind("", TEST_PORT, 1)
+    raw = socket.create_connection(("127.0.0.1", TEST_PORT), timeout=1)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+
+    # a peer that never stops sending, for up to 3 seconds
+    frames = PacketTestServerbound(string=TEST_STRING).serialise(True) * 1000
+    def flood():
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            try:
+                raw.sendall(frames)
+            except OSError:
+                return
+    flooder = threading.Thread(target=flood)
+    flooder.start()
+    pump = asyncio.create_task(server_peer_socket.pump())
+
+    # everything else on the loop still gets its turns meanwhile
+    ticks = 0
+    async def consumer():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            while server_peer_socket.inbound_pending():
+                server_peer_socket.read_packet()
+            await asyncio.sleep(0)
+    consumer_task = asyncio.create_task(consumer())
+    started = time.monotonic()
+    await asyncio.sleep(0.2)
+    slept = time.monotonic() - started
+    received = server_peer_socket.queue_stats()["inbound_peak"]
+
+    consumer_task.cancel()
+    pump.cancel()
+    # closing our end is what stops the flooder, a send blocked on a full buffer doesn't notice its own socket closing
+    server_peer_socket.close()
+    flooder.join()
+    raw.close()
+    server_host_socket.close()
+    assert slept < 1, f"a 0.2s sleep took {slept:.2f}s while a peer was flooding"
+    assert ticks > 10, f"another task only got {ticks} turns while a peer was flooding"
+    assert received > 0, "nothing was received from the flooding peer"
+
+class PacketLargeServerbound(Packet):
+    _serverbound: bool = True
+
+    blob: pack.fixed(10_000_000) # type: ignore
+
+async def _small_packet_latencies(executor: ThreadPoolExecutor|None, duration: float) -> list[float]:
+    # one client pings the server with small packets while another keeps it busy decrypting large ones
+    server_host_socket = ProtoSocket(False, 10, 5)
+    server_host_socket.bind("", TEST_PORT, 2)
+    if executor: server_host_socket.set_executor(executor)
+    sockets = [server_host_socket]
+    pumps = []
+    for _ in range(2):
+        client_socket = CryptSocket(ProtoSocket(True, 10, 5))
+        client_socket.connect("127.0.0.1", TEST_PORT)
+        server_peer_socket, _ = await server_host_socket.accept()
+        server_peer_socket = CryptSocket(server_peer_socket)
+        server_peer_socket.set_encryption(AESCrypter(TEST_KEY))
+        client_socket.set_encryption(AESCrypter(TEST_KEY))
+        if executor: client_socket.set_executor(executor)
+        pumps += [asyncio.create_task(client_socket.pump()), asyncio.create_task(server_peer_socket.pump())]
+        sockets += [client_socket, server_peer_socket]
+    pinger, ping_server, bulk_client, bulk_server = sockets[1:]
+
+    async def echo():
+        while True:
+            packet = await ping_server.next_packet()
+            ping_server.write_packet(PacketTestClientbound(string=packet.string))
+    async def bulk():
+        while True:
+            bulk_client.write_packet(PacketLargeServerbound(blob=bytes(10_000_000)))
+            await bulk_server.wait_for_packet(PacketLargeServerbound)
+    tasks = [asyncio.create_task(echo()), asyncio.create_task(bulk())]
+    latencies = []
+    started = time.monotonic()
+    while time.monotonic() - started < duration:
+        sent = time.perf_counter()
+        pinger.write_packet(PacketTestServerbound(string=TEST_STRING))
+        await pinger.wait_for_packet(PacketTestClientbound)
+        latencies.append(time.perf_counter() - sent)
+        await asyncio.sleep(0.005)
+
+    for task in tasks + pumps:
+        task.cancel()
+    await asyncio.gather(*tasks, *pumps, return_exceptions=True)
+    for sock in sockets:
+        sock.close()
+    return sorted(latencies)
+
+OFFLOADED_P99_BUDGET = 50 # ms
+
+async def main_offload_latency():
+    inline = await _small_packet_latencies(None, 2)
+    with ThreadPoolExecutor(2) as executor:
+        offloaded = await _small_packet_latencies(executor, 2)
+    p99 = lambda latencies: latencies[int(len(latencies) * 0.99)] * 1000
+    print()
+    print(f"small packet latency under 10MB payloads: p50 {inline[len(inline)//2]*1000:.1f}ms p99 {p99(inline):.1f}ms inline, "
+          f"p50 {offloaded[len(offloaded)//2]*1000:.1f}ms p99 {p99(offloaded):.1f}ms offloaded ({len(inline)} vs {len(offloaded)} pings)")
+    # an absolute bound rather than a comparison with inline, which only gets noisier the busier the machine is.
+    # a 10MB payload takes tens of milliseconds to decrypt, so a p99 under the bound means pings weren't stuck behind it
+    assert p99(offloaded) < OFFLOADED_P99_BUDGET, f"offloaded p99 {p99(offloaded):.1f}ms, budget is {OFFLOADED_P99_BUDGET}ms"
+
+class FixedRecordTLSSteganoLayer(TLSSteganoLayer):
+    # records and reads sized the way they were before adaptive record sizing
+    recv_size = 1024
+    def next_chunk_size(self) -> int:
+        return self.chunk_size
+
+async def _tls_stegano_transfer(layer_cls: type, count: int, size: int) -> tuple[float, int]: # seconds, records
+    server_host_socket = ProtoSocket(False, 10, 5, layer_cls())
+    client_host_socket = ProtoSocket(True,  10, 5, layer_cls())
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, _ = await server_host_socket.accept()
+
+    records = 0
+    wrap = server_peer_socket._steganolayer.wrap
+    def counting_wrap(data):
+        nonlocal records
+        records += 1
+        return wrap(data)
+    server_peer_socket._steganolayer.wrap = counting_wrap
+    pumps = [asyncio.create_task(server_peer_socket.pump()), asyncio.create_task(client_host_socket.pump())]
+
+    blob = b"x" * size
+    started = time.perf_counter()
+    for _ in range(count):
+        server_peer_socket.write_packet(PacketTestClientbound(string=blob))
+    for _ in range(count):
+        assert (await client_host_socket.next_packet(10)).string == blob
+    elapsed = time.perf_counter() - started
+
+    for pump in pumps:
+        pump.cancel()
+    await asyncio.gather(*pumps, return_exceptions=True)
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+    return elapsed, records
+
+async def main_tls_record_sizing():
+    layer = TLSSteganoLayer()
+    sizes = [layer.next_chunk_size() for _ in range(64)]
+    # small while a burst starts, the TLS limit once it's bulk, small again after going idle
+    assert sizes[0] == layer.small_record_size and sizes[-1] == layer.max_record_size
+    layer._last_record -= layer.idle_reset + 1
+    assert layer.next_chunk_size() == layer.small_record_size
+
+    fixed, fixed_records = await _tls_stegano_transfer(FixedRecordTLSSteganoLayer, 64, 131072)
+    adaptive, adaptive_records = await _tls_stegano_transfer(TLSSteganoLayer, 64, 131072)
+    print()
+    print(f"8MB through TLSSteganoLayer: {fixed_records} records in {fixed*1000:.0f}ms ({8/fixed:.0f}MB/s) with fixed 1KiB records, "
+          f"{adaptive_records} records in {adaptive*1000:.0f}ms ({8/adaptive:.0f}MB/s) adaptive")
+    assert adaptive_records * 8 < fixed_records
+
+async def main_metrics():
+    server_host_socket = ProtoSocket(False, 0.2, 5)
+    client_host_socket = CryptSocket(ProtoSocket(True,  0.2, 5))
+    server_host_socket.enable_metrics()
+    client_host_socket.enable_metrics()
+
+    server_host_socket.bind("", TEST_PORT, 1)
+    client_host_socket.connect("127.0.0.1", TEST_PORT)
+    server_peer_socket, server_peer_address = await server_host_socket.accept()
+    # the accepted socket counts for itself
+    assert server_peer_socket._metrics is not None and server_peer_socket._metrics is not server_host_socket._metrics
+
+    server_peer_socket = CryptSocket(server_peer_socket)
+    server_peer_socket.set_encryption(AESCrypter(TEST_KEY))
+    client_host_socket.set_encryption(AESCrypter(TEST_KEY))
+    pumps = [asyncio.create_task(server_peer_socket.pump()), asyncio.create_task(client_host_socket.pump())]
+
+    for _ in range(10):
+        client_host_socket.write_packet(PacketTestServerbound(string=TEST_STRING))
+    for _ in range(10):
+        await server_peer_socket.next_packet(1)
+    await asyncio.sleep(0.5) # a couple of heartbeats
+
+    client, server = client_host_socket.metrics(), server_peer_socket.metrics()
+    assert client["counters"]["packets_sent"] >= 10 and server["counters"]["packets_received"] >= 10
+    assert client["counters"]["bytes_sent"] == server["counters"]["bytes_received"]
+    assert client["histograms"]["encrypt_seconds"]["count"] == client["counters"]["packets_sent"]
+    assert server["histograms"]["decrypt_seconds"]["count"] == server["counters"]["packets_received"]
+    rtt = client["histograms"]["heartbeat_rtt_seconds"]
+    assert rtt["count"] >= 1 and rtt["buckets"][-1] == (float("inf"), rtt["count"])
+    assert server["gauges"]["inbound"] == 0 and "decode_errors" not in server["counters"]
+
+    # a frame that doesn't decrypt is counted before it takes the connection down
+    await client_host_socket._sendmsg([pack.uint32.serialise((len(TEST_STRING),))[1] + TEST_STRING])
+    try:
+        await asyncio.wait_for(pumps[0], 1)
+        assert False, "undecryptable frame went unnoticed"
+    except ValueError:
+        pass
+    assert server_peer_socket.metrics()["counters"]["decode_errors"] == 1
+
+    # nothing is counted without metrics enabled
+    assert ProtoSocket(False, 1, 5).metrics() is None
+
+    pumps[1].cancel()
+    client_host_socket.close()
+    server_peer_socket.close()
+    server_host_socket.close()
+
 def test_protosocket(): asyncio.run(main_protosocket())
 def test_protosocket_stegano(): asyncio.run(main_protosocket_stegano())
 def test_cryptsocket(): asyncio.run(main_cryptsocket())
-def test_cryptsocket_stegano(): asyncio.run(main_cryptsocket_stegano())
\ No newline at end of file
+def test_cryptsocket_stegano(): asyncio.run(main_cryptsocket_stegano())
+def test_wait_for_packet(): asyncio.run(main_wait_for_packet())
+def test_recv_buffer(): asyncio.run(main_recv_buffer())
+def test_burst(): asyncio.run(main_burst())
+def test_write_coalescing(): asyncio.run(main_write_coalescing())
+def test_queue_limits(): asyncio.run(main_queue_limits())
+def test_idle(): asyncio.run(main_idle())
+def test_flood_fairness(): asyncio.run(main_flood_fairness())
+def test_offload_latency(): asyncio.run(main_offload_latency())
+def test_tls_record_sizing(): asyncio.run(main_tls_record_sizing())
+def test_metrics(): asyncio.run(main_metrics())
@@ -1,4 +1,8 @@
+import time
+
 from hyphen0.stegano import HTTPSteganoLayer, TLSSteganoLayer
+from hyphen0.stegano._layer import SteganoLayer
+from hyphen0.exceptions import IncompleteData
 
 def test_steganolayer_http():
     testsend = HTTPSteganoLayer()
@@ -13,14 +17,78 @@ def test_steganolayer_http():
     testsend.push_send(b"helloworld")
     pulled1 = testsend.pull_send(5)
     pulled2 = testsend.pull_send(5)
-    assert pulled1 == b'POST /testtesttest HTTP/1.1\nConnection: keep-alive\nCache-Control: max-age=0\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0\nAccept: */*\nContent-Length: 8\n\naGVsbG8='
-    assert pulled2 == b'POST /testtesttest HTTP/1.1\nConnection: keep-alive\nCache-Control: max-age=0\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0\nAccept: */*\nContent-Length: 8\n\nd29ybGQ='
+    assert pulled1 == b'POST /testtesttest HTTP/1.1\r\nConnection: keep-alive\r\nCache-Control: max-age=0\r\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0\r\nAccept: */*\r\nContent-Length: 8\r\n\r\naGVsbG8='
+    assert pulled2 == b'POST /testtesttest HTTP/1.1\r\nConnection: keep-alive\r\nCache-Control: max-age=0\r\nUser-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36 Edg/138.0.0.0\r\nAccept: */*\r\nContent-Length: 8\r\n\r\nd29ybGQ='
 
     testrecv.push_recv(pulled1)
     testrecv.push_recv(pulled2)
     assert testrecv.pull_recv(5) == b"hello"
     assert testrecv.pull_recv(5) == b"world"
 
+def test_steganolayer_http_binary_chunked():
+    testsend = HTTPSteganoLayer(binary=True, chunked=True)
+    testrecv = HTTPSteganoLayer()
+    testsend.set_serverbound(False)
+    testrecv.set_serverbound(True)
+
+    testsend.push_send(b"helloworld")
+    pulled1 = testsend.pull_send(5)
+    pulled2 = testsend.pull_send(5)
+    # the header only goes out once, every frame after it is just a chunk
+    assert pulled1 == b'HTTP/1.1 200 OK\r\nConnection: keep-alive\r\nCache-Control: max-age=0\r\nContent-Type: application/octet-stream\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n'
+    assert pulled2 == b'5\r\nworld\r\n'
+
+    # the receiving end picks the body mode up from the headers
+    testrecv.push_recv(pulled1)
+    testrecv.push_recv(pulled2)
+    assert testrecv.pull_recv(10) == b"helloworld"
+
+    # accepted connections get their own layer with the same settings
+    copied = testsend.copy()
+    assert (copied.binary, copied.chunked, copied.serverbound) == (True, True, False)
+    assert not copied._send_streaming
+
+def test_steganolayer_http_incremental_header():
+    testsend = HTTPSteganoLayer()
+    testrecv = HTTPSteganoLayer()
+    testsend.set_serverbound(True)
+    testrecv.set_serverbound(False)
+    testsend._useragent_str = "Mozilla/5.0"
+
+    testsend.push_send(b"x" * 3000)
+    wrapped = testsend.pull_send(3000)
+    header_size = wrapped.index(b"\r\n\r\n") + 4
+    buf = bytearray(b"junk")
+    for i, byte in enumerate(wrapped):
+        # incomplete frames are reported as such, never as malformed ones
+        try:
+            testrecv.unwrap_from(buf, 4)
+            assert False, "unwrapped an incomplete frame"
+        except IncompleteData:
+            pass
+        # a partial header is only ever scanned on from where the last attempt left off, a complete one is kept
+        assert testrecv._header_scanned == (i if i < header_size else 0)
+        assert (testrecv._parsed_header is not None) == (i >= header_size)
+        buf.append(byte)
+    assert testrecv.unwrap_from(buf, 4) == (len(buf), b"x" * 3000)
+    assert testrecv._parsed_header is None
+
+def test_steganolayer_http_overhead():
+    payload = bytes(range(256)) * 4096 # 1MB
+    sizes = {}
+    for name, layer in (("base64", HTTPSteganoLayer()), ("binary", HTTPSteganoLayer(binary=True)),
+                        ("chunked", HTTPSteganoLayer(16384, binary=True, chunked=True))):
+        layer.set_serverbound(True)
+        layer._useragent_str = "Mozilla/5.0"
+        layer.push_send(payload)
+        sizes[name] = 0
+        while layer.can_pull_send():
+            sizes[name] += len(layer.pull_send(layer.chunk_size))
+    print(", ".join(f"{name}: {size/len(payload):.3f}x" for name, size in sizes.items()))
+    assert sizes["base64"] > len(payload) * 4/3
+    assert sizes["binary"] < len(payload) * 1.2
+    assert sizes["chunked"] < len(payload) * 1.01
+
 def test_steganolayer_tls():
     testsend = TLSSteganoLayer()
     testrecv = TLSSteganoLayer()
@@ -37,4 +105,72 @@ def test_steganolayer_tls():
     testrecv.push_recv(pulled1)
     testrecv.push_recv(pulled2)
     assert testrecv.pull_recv(5) == b"hello"
-    assert testrecv.pull_recv(5) == b"world"
\ No newline at end of file
+    assert testrecv.pull_recv(5) == b"world"
+
+class LengthPrefixedSteganoLayer(SteganoLayer):
+    # written against the original interface: only wrap() and unwrap(), and no __init__ calling ours
+    def wrap(self, data: bytes) -> bytes:
+        return len(data).to_bytes(2, 'big') + data
+    def unwrap(self, data: bytes) -> tuple[int, bytes]:
+        if len(data) < 2 or len(data) < 2 + int.from_bytes(data[0:2], 'big'):
+            raise IncompleteData()
+        size = int.from_bytes(data[0:2], 'big')
+        return 2+size, data[2:2+size]
+
+def test_steganolayer_unwrap_only():
+    testsend, testrecv = LengthPrefixedSteganoLayer(), LengthPrefixedSteganoLayer().copy()
+    testsend.push_send(b"helloworld")
+    testrecv.push_recv(testsend.pull_send(5) + testsend.pull_send(5))
+    assert testrecv.unwrap_from(testrecv.recv_buffer.buf, 7) == (14, b"world")
+    assert testrecv.pull_recv(100) == b"helloworld"
+    try:
+        SteganoLayer().unwrap_from(b"hello")
+        assert False, "a layer implementing neither unwrap() nor unwrap_from() unwrapped something"
+    except NotImplementedError:
+        pass
+
+def test_steganolayer_partial_frames():
+    for make_layer in (TLSSteganoLayer, HTTPSteganoLayer, lambda: HTTPSteganoLayer(binary=True, chunked=True), LengthPrefixedSteganoLayer):
+        testsend = make_layer()
+        testrecv = make_layer()
+        testsend.set_serverbound(True)
+        testrecv.set_serverbound(False)
+        testsend._useragent_str = testrecv._useragent_str = "Mozilla/5.0"
+
+        testsend.push_send(b"helloworld")
+        wrapped = testsend.pull_send(5) + testsend.pull_send(5)
+        # frames split at every possible point still come out whole, and nothing comes out before they're complete
+        received = b""
+        for i in range(len(wrapped)):
+            testrecv.push_recv(wrapped[i:i+1])
+            received += testrecv.pull_recv(100)
+            assert b"helloworld".startswith(received)
+        assert received == b"helloworld"
+        assert not testrecv.can_pull_recv()
+
+def test_steganolayer_streaming_linear():
+    for make_layer in (TLSSteganoLayer, HTTPSteganoLayer, lambda: HTTPSteganoLayer(binary=True, chunked=True)):
+        testsend = make_layer()
+        testrecv = make_layer()
+        testsend.set_serverbound(True)
+        testrecv.set_serverbound(False)
+        testsend._useragent_str = testrecv._useragent_str = "Mozilla/5.0"
+
+        payload = bytes(range(256)) * 16384 # 4MB
+        testsend.push_send(payload)
+        wrapped = bytearray()
+        while testsend.can_pull_send():
+            wrapped += testsend.pull_send(testsend.chunk_size)
+
+        started = time.perf_counter()
+        received = []
+        # arriving in odd sized pieces, so frames keep getting split, while only a little is pulled at a time
+        for i in range(0, len(wrapped), 1500):
+            testrecv.push_recv(wrapped[i:i+1500])
+            received.append(testrecv.pull_recv(500))
+        while testrecv.can_pull_recv():
+            received.append(testrecv.pull_recv(500))
+        elapsed = time.perf_counter() - started
+        assert b"".join(received) == payload
+        # re-slicing the whole backlog on every pull takes a couple of seconds here
+        assert elapsed < 1, f"{type(testsend).__name__} took {elapsed:.2f}s to unwrap 4MB"
@@ -1,11 +1,19 @@
 import asyncio
 import time
 import random
+import socket
+import sys
+import os
+import multiprocessing
+import logging
 
 from hyphen0.server import Hyphen0Server
 from hyphen0.client import Hyphen0Client
 
 from hyphen0.stegano import TLSSteganoLayer
+from hyphen0.socket import ProtoSocket, CryptSocket
+from hyphen0.packets import Packet, pack
+from hyphen0.encryption.aes import AESCrypter
 
 from Crypto.PublicKey import ECC
 
@@ -132,6 +140,466 @@ async def main_stegano_multi():
     assert client1.connected, "client1 did not connect"
     assert client2.connected, "client2 did not connect"
 
+class PacketBroadcastClientbound(Packet):
+    _serverbound: bool = False
+
+    sender: pack.cstring # type: ignore
+    message: pack.cstring # type: ignore
+
+async def main_broadcast():
+    server = HP0TestServer('', TEST_PORT)
+    server._trace_hooks = False
+    keys = {}
+    raw_clients = []
+    # skip the handshake, it's not what's being measured here
+    for i in range(1000):
+        raw = socket.create_connection(('127.0.0.1', TEST_PORT))
+        raw_clients.append(raw)
+        client, addr = await server._socket.accept()
+        client = CryptSocket(client)
+        keys[raw.getsockname()] = key = random.randbytes(32)
+        client.set_encryption(AESCrypter(key))
+        server._connected_clients[client.getnicename()] = {'upd': None, 'sock': client}
+    clients = server.get_clients()
+    packet = PacketBroadcastClientbound(sender=b"server", message=b"hello everyone! " * 8)
+
+    started = time.perf_counter()
+    for client in clients:
+        client.write_packet(packet)
+    await asyncio.gather(*(client.update(0) for client in clients))
+    looped = time.perf_counter() - started
+
+    started = time.perf_counter()
+    assert server.broadcast(packet) == 1000
+    await asyncio.gather(*(client.update(0) for client in clients))
+    broadcast = time.perf_counter() - started
+    print(f"\n1k-client fan-out: write_packet loop {looped*1000:.1f}ms, broadcast {broadcast*1000:.1f}ms")
+
+    assert server.broadcast(packet, filter=lambda client: False) == 0
+    for raw in raw_clients[:10]:
+        crypter = AESCrypter(keys[raw.getsockname()])
+        raw.settimeout(1)
+        data = b''
+        for _ in range(2):
+            while len(data) < 4 or len(data) < 4 + int.from_bytes(data[:4], sys.byteorder):
+                data += raw.recv(65536)
+            size = int.from_bytes(data[:4], sys.byteorder)
+            _, received = Packet.deserialise(crypter.decrypt(data[4:4+size]), False)
+            data = data[4+size:]
+            assert isinstance(received, PacketBroadcastClientbound)
+            assert received.message == packet.message
+
+    for raw in raw_clients:
+        raw.close()
+    for client in clients:
+        client.close()
+    await server.close()
+
+async def main_broadcast_stalled():
+    server = HP0TestServer('', TEST_PORT)
+    server.set_queue_limits(outbound=8) # default policy, "drain"
+    raw_clients, clients = [], []
+    for i in range(2):
+        raw_clients.append(socket.create_connection(('127.0.0.1', TEST_PORT)))
+        client, addr = await server._socket.accept()
+        client = CryptSocket(client)
+        client.set_encryption(AESCrypter(random.randbytes(32)))
+        server._connected_clients[client.getnicename()] = {'upd': None, 'sock': client}
+        clients.append(client)
+    stalled, healthy = clients
+    packet = PacketBroadcastClientbound(sender=b"server", message=b"hello everyone!")
+
+    # the stalled client's queue is never sent, the healthy one's is after every broadcast
+    reached = []
+    for _ in range(100):
+        reached.append(server.broadcast(packet))
+        await healthy.update(0)
+    assert reached == [2] * 8 + [1] * 92
+    assert stalled._outbound_depth() == 8
+    assert healthy._outbound_depth() == 0
+
+    for raw in raw_clients:
+        raw.close()
+    for client in clients:
+        client.close()
+    await server.close()
+
+class HP0ModesTestServer(HP0TestServer):
+    RANK_ENCRYPTION_MODES = False
+    selected = None
+    async def _event_crypt_modeselected(self, client, mode):
+        self.selected = mode
+
+async def main_modes():
+    for client_modes, expected in (({'aes': AESCrypter}, 'aes'),
+                                   (dict(reversed(Hyphen0Client.ENCRYPTION_MODES.items())), next(iter(Hyphen0Server.ENCRYPTION_MODES)))):
+        server = HP0ModesTestServer('', TEST_PORT)
+        client = HP0TestClient('localhost', TEST_PORT)
+        # an older client only knowing aes still gets through, otherwise server's preference wins over client's
+        client.ENCRYPTION_MODES = client_modes
+        server.set_keypair(ECC.generate(curve='p256'))
+        client.set_keypair(ECC.generate(curve='p256'))
+
+        server_task = asyncio.create_task(server.mainloop())
+        client_task = asyncio.create_task(client.mainloop())
+        start_time = time.time()
+        while time.time()-start_time < 1 and not client.connected:
+            for task in (server_task, client_task):
+                if task.done() and task.exception(): raise task.exception()
+            await asyncio.sleep(0)
+        await server.close()
+        assert client.connected, "client did not connect"
+        assert server.selected == expected
+
+class PacketShoutServerbound(Packet):
+    _serverbound: bool = True
+
+    message: pack.cstring # type: ignore
+
+class HP0WorkersTestServer(HP0TestServer):
+    _trace_hooks = False
+    async def _event_packet_received(self, client, packet):
+        if isinstance(packet, PacketShoutServerbound):
+            self.broadcast(PacketBroadcastClientbound(sender=str(os.getpid()).encode(), message=packet.message))
+class HP0WorkersTestClient(HP0TestClient):
+    _trace_hooks = False
+    RANK_ENCRYPTION_MODES = False
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ready = asyncio.Event()
+        self.heard = []
+    async def _event_ticket_received(self, ticket):
+        # the server sends it after it got to know us, so we won't miss broadcasts from here on
+        self.ready.set()
+    async def _event_packet_received(self, packet):
+        if isinstance(packet, PacketBroadcastClientbound):
+            self.heard.append(packet)
+
+def _serve_workers(port: int, workers: int):
+    server = HP0WorkersTestServer('', port)
+    server.set_keypair(ECC.generate(curve='p256'))
+    server.serve(workers)
+def _start_workers(port: int, workers: int) -> multiprocessing.Process:
+    process = multiprocessing.get_context("fork").Process(target=_serve_workers, args=(port, workers))
+    process.start()
+    return process
+
+async def _connect_worker(port: int, keypair: ECC.EccKey) -> tuple[HP0WorkersTestClient, asyncio.Task]:
+    # workers might not be listening yet
+    deadline = time.monotonic() + 10
+    while True:
+        client = HP0WorkersTestClient('localhost', port)
+        client.set_keypair(keypair)
+        task = asyncio.create_task(client.mainloop())
+        await asyncio.wait((task, asyncio.create_task(client.ready.wait())), return_when=asyncio.FIRST_COMPLETED)
+        if client.ready.is_set():
+            return client, task
+        if time.monotonic() > deadline: task.result()
+        await asyncio.sleep(0.05)
+
+async def main_workers():
+    keypair = ECC.generate(curve='p256')
+    connected = [await _connect_worker(TEST_PORT, keypair) for _ in range(16)]
+    clients = [client for client, _ in connected]
+    for client in clients:
+        client._socket.write_packet(PacketShoutServerbound(message=b"hello from " + str(id(client)).encode()))
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and any(len(client.heard) < len(clients) for client in clients):
+        await asyncio.sleep(0.01)
+    # every client hears every shout, whichever worker it landed on
+    for client in clients:
+        assert sorted(packet.message for packet in client.heard) == sorted(b"hello from " + str(id(other)).encode() for other in clients)
+    assert len({packet.sender for packet in clients[0].heard}) == 2, "connections weren't spread over workers"
+    for client, task in connected:
+        await client.close()
+        task.cancel()
+
+async def _handshake_once(port: int, keypair: ECC.EccKey):
+    client, task = await _connect_worker(port, keypair)
+    await client.close()
+    task.cancel()
+
+def _wait_for_workers(port: int, workers: int):
+    # one handshake per worker before anything is timed. SO_REUSEPORT decides who gets which connection, so this
+    # doesn't guarantee every worker served one, but connecting only succeeds once the workers are listening
+    async def handshakes():
+        keypair = ECC.generate(curve='p256')
+        await asyncio.gather(*(_handshake_once(port, keypair) for _ in range(workers)))
+    asyncio.run(handshakes())
+
+def _count_handshakes(port: int, duration: float) -> int:
+    async def handshakes():
+        keypair = ECC.generate(curve='p256')
+        await _handshake_once(port, keypair) # warms this process up, not counted
+        count = 0
+        started = time.monotonic()
+        while time.monotonic() - started < duration:
+            await _handshake_once(port, keypair)
+            count += 1
+        return count
+    return asyncio.run(handshakes())
+
+def _handshake_rate(workers: int, duration: float = 2) -> float:
+    # clients run in as many processes as the server has workers, so they aren't what's being saturated
+    server = _start_workers(TEST_PORT, workers)
+    try:
+        _wait_for_workers(TEST_PORT, workers)
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            return sum(pool.starmap(_count_handshakes, [(TEST_PORT, duration)] * workers)) / duration
+    finally:
+        server.terminate()
+        server.join()
+
+def test_svclient_workers():
+    server = _start_workers(TEST_PORT, 2)
+    try:
+        asyncio.run(main_workers())
+    finally:
+        server.terminate()
+        server.join()
+    assert server.exitcode == 0
+def test_svclient_workers_scaling():
+    workers = max(2, min(4, (os.cpu_count() or 1) // 2))
+    single = _handshake_rate(1)
+    sharded = _handshake_rate(workers)
+    print(f"\nhandshakes/s: {single:.0f} with 1 worker, {sharded:.0f} with {workers} ({sharded/single:.2f}x)")
+    if (os.cpu_count() or 1) >= workers * 2:
+        assert sharded / single > workers * 0.6
+class HP0FastOnlyTestServer(HP0TestServer):
+    async def _legacy_handshake(self, client, update_task):
+        raise AssertionError("fast client went through the legacy handshake")
+class HP0LegacyTestClient(HP0TestClient):
+    FAST_HANDSHAKE = False
+class HP0OtherVersionTestClient(HP0TestClient):
+    # speaks a protocol version the server doesn't, whichever handshake it opens with
+    def _connect(self):
+        update_task = super()._connect()
+        write_packet = self._socket.write_packet
+        def write_other_version(packet):
+            if hasattr(packet, "version"): packet.version += 1
+            write_packet(packet)
+        self._socket.write_packet = write_other_version
+        return update_task
+
+async def main_fast_handshake():
+    for server_cls, client_cls in ((HP0FastOnlyTestServer, HP0TestClient),
+                                   (HP0TestServer, HP0LegacyTestClient)):
+        server = server_cls('', TEST_PORT)
+        client = client_cls('localhost', TEST_PORT)
+        server.set_keypair(ECC.generate(curve='p256'))
+        client.set_keypair(ECC.generate(curve='p256'))
+
+        server_task = asyncio.create_task(server.mainloop())
+        client_task = asyncio.create_task(client.mainloop())
+        start_time = time.time()
+        while time.time()-start_time < 2 and not client.connected:
+            for task in (server_task, client_task):
+                if task.done() and task.exception(): raise task.exception()
+            await asyncio.sleep(0)
+        assert client.connected, f"{client_cls.__name__} did not connect to {server_cls.__name__}"
+        client_task.cancel()
+        await client.close()
+        await server.close()
+
+async def main_fresh_session_keys():
+    # the same keypairs on both ends, reconnecting over and over, still get a different key every session
+    server = HP0TestServer('', TEST_PORT)
+    server.set_keypair(ECC.generate(curve='p256'))
+    server_task = asyncio.create_task(server.mainloop())
+    keypair = ECC.generate(curve='p256')
+    keys = []
+    for client_cls in (HP0TestClient, HP0TestClient, HP0LegacyTestClient, HP0LegacyTestClient):
+        client = client_cls('localhost', TEST_PORT)
+        client.set_keypair(keypair)
+        client_task = asyncio.create_task(client.mainloop())
+        start_time = time.time()
+        while time.time()-start_time < 2 and not client.connected:
+            for task in (server_task, client_task):
+                if task.done() and task.exception(): raise task.exception()
+            await asyncio.sleep(0)
+        assert client.connected, f"{client_cls.__name__} did not connect"
+        keys.append(client._socket._encryption._key)
+        client_task.cancel()
+        await client.close()
+    assert len(set(keys)) == len(keys), "two sessions between the same keypairs got the same key"
+    await server.close()
+
+async def main_version_mismatch():
+    server = HP0TestServer('', TEST_PORT)
+    server.set_keypair(ECC.generate(curve='p256'))
+    server_task = asyncio.create_task(server.mainloop())
+    await asyncio.sleep(0)
+    for fast in (True, False):
+        client = HP0OtherVersionTestClient('localhost', TEST_PORT)
+        client.FAST_HANDSHAKE = fast
+        client.set_keypair(ECC.generate(curve='p256'))
+        try:
+            await asyncio.wait_for(client.mainloop(), 2)
+        except ValueError as e:
+            assert "unsupported protocol version" in str(e), e
+        else:
+            raise AssertionError("client on another protocol version connected")
+        assert not client.connected
+    assert not server_task.done()
+    await server.close()
+
+class HP0TicketTestServer(HP0TestServer):
+    key_agreements = 0
+    def _key_agreement(self, public_key, salt):
+        self.key_agreements += 1
+        return super()._key_agreement(public_key, salt)
+
+async def main_resumption():
+    server = HP0TicketTestServer('', TEST_PORT)
+    server.set_keypair(ECC.generate(curve='p256'))
+    server_task = asyncio.create_task(server.mainloop())
+
+    async def connect(ticket):
+        client = HP0TestClient('localhost', TEST_PORT)
+        client.set_keypair(ECC.generate(curve='p256'))
+        client.set_ticket(ticket)
+        client_task = asyncio.create_task(client.mainloop())
+        start_time = time.time()
+        while time.time()-start_time < 2 and client.ticket in (None, ticket):
+            for task in (server_task, client_task):
+                if task.done() and task.exception(): raise task.exception()
+            await asyncio.sleep(0)
+        assert client.connected, "client did not connect"
+        assert client.ticket not in (None, ticket), "client did not get a ticket"
+        client_task.cancel()
+        await client.close()
+        return client.ticket
+
+    first = await connect(None)
+    assert server.key_agreements == 1
+    # a ticket resumes once without a key exchange, and comes with a new one
+    second = await connect(first)
+    assert server.key_agreements == 1
+    await connect(second)
+    assert server.key_agreements == 1
+    # a replayed one is turned down, and the client falls back to a full handshake on the same connection
+    await connect(first)
+    assert server.key_agreements == 2
+    await server.close()
+
+class PacketMetricsServerbound(Packet):
+    _serverbound: bool = True
+
+    message: pack.cstring # type: ignore
+
+async def main_metrics():
+    server = HP0TestServer('', TEST_PORT)
+    server._trace_hooks = False
+    client = HP0TestClient('localhost', TEST_PORT)
+    server.set_keypair(ECC.generate(curve='p256'))
+    client.set_keypair(ECC.generate(curve='p256'))
+    assert server.metrics() is None and server.export_metrics() == ""
+    server.enable_metrics()
+    client.enable_metrics()
+    received = []
+    server.add_hook("ptype_PacketMetricsServerbound_received", "test", lambda client, packet: received.append(packet))
+
+    server_task = asyncio.create_task(server.mainloop())
+    client_task = asyncio.create_task(client.mainloop())
+    start_time, sent = time.time(), False
+    while time.time()-start_time < 2 and len(received) < 10:
+        for task in (server_task, client_task):
+            if task.done() and task.exception(): raise task.exception()
+        if client.connected and not sent:
+            for _ in range(10): client._socket.write_packet(PacketMetricsServerbound(message=b"hello"))
+            sent = True
+        await asyncio.sleep(0)
+    assert len(received) == 10, "server did not get the packets"
+
+    snapshot = server.metrics()
+    assert snapshot["counters"]["handshakes_fast"] == 1 and snapshot["histograms"]["handshake_seconds"]["count"] == 1
+    assert snapshot["counters"]["packets_received"] >= 10 and snapshot["gauges"]["connections"] == 1
+    assert client.metrics()["counters"]["handshakes_fast"] == 1
+    text = server.export_metrics(per_connection=True)
+    assert "# TYPE hyphen0_packets_received_total counter" in text
+    assert "# TYPE hyphen0_handshake_seconds histogram" in text
+    assert '\nhyphen0_connection_bytes_received_total{peer="127.0.0.1:' in text
+    assert "# TYPE hyphen0_packets_sent_total counter" in client.export_metrics()
+
+    # what a connection counted outlives it
+    client_task.cancel()
+    await client.close()
+    start_time = time.time()
+    while time.time()-start_time < 2 and server.get_clients():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.01)
+    snapshot = server.metrics()
+    assert snapshot["gauges"]["connections"] == 0 and snapshot["counters"]["packets_received"] >= 10
+    await server.close()
+
+class _RecordsHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+    def emit(self, record):
+        self.records.append(record)
+
+class HP0SampledTestServer(HP0TestServer):
+    PACKET_TRACE_SAMPLE = 10
+
+async def main_logging():
+    handler = _RecordsHandler()
+    logger = logging.getLogger("hyphen0")
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        server = HP0SampledTestServer('', TEST_PORT)
+        client = HP0TestClient('localhost', TEST_PORT)
+        server.set_keypair(ECC.generate(curve='p256'))
+        client.set_keypair(ECC.generate(curve='p256'))
+        received = []
+        server.add_hook("packet_received", "test", lambda client, packet: received.append(packet))
+
+        server_task = asyncio.create_task(server.mainloop())
+        client_task = asyncio.create_task(client.mainloop())
+        start_time, sent = time.time(), False
+        while time.time()-start_time < 2 and len(received) < 25:
+            for task in (server_task, client_task):
+                if task.done() and task.exception(): raise task.exception()
+            if client.connected and not sent:
+                for _ in range(25): client._socket.write_packet(PacketMetricsServerbound(message=b"hello"))
+                sent = True
+            await asyncio.sleep(0)
+        assert len(received) == 25, "server did not get the packets"
+        await server.close()
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    by_logger = {}
+    for record in handler.records:
+        by_logger.setdefault(record.name, []).append(record.getMessage())
+    assert any(message.startswith("serving on") for message in by_logger["hyphen0.server"])
+    assert any("client_connected" in message for message in by_logger["hyphen0.hooks"])
+    # packets stay out of the hook trace, and only every 10th one is traced
+    events = [message.split()[1] for message in by_logger["hyphen0.hooks"]]
+    assert "packet_received" not in events and not any(event.startswith("ptype_") for event in events)
+    assert len(by_logger["hyphen0.packets"]) == 2
+
+def test_svclient_logging():
+    asyncio.run(main_logging())
+def test_svclient_metrics():
+    asyncio.run(main_metrics())
+def test_svclient_resumption():
+    asyncio.run(main_resumption())
+def test_svclient_fresh_session_keys():
+    asyncio.run(main_fresh_session_keys())
+def test_svclient_version_mismatch():
+    asyncio.run(main_version_mismatch())
+def test_svclient_fast_handshake():
+    asyncio.run(main_fast_handshake())
+def test_svclient_modes():
+    asyncio.run(main_modes())
+def test_svclient_broadcast_stalled():
+    asyncio.run(main_broadcast_stalled())
+def test_svclient_broadcast():
+    asyncio.run(main_broadcast())
 def test_svclient_stegano_single():
     asyncio.run(main_stegano_single())
 def test_svclient_stegano_multi():